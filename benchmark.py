@@ -0,0 +1,247 @@
+"""Benchmarks for gemini.py.
+
+    python benchmark.py startup [--runs N] [--state DIR] [--timeout S] [--max-first-frame MS] [--max-first-api-call MS]
+    python benchmark.py loop [--cycles N] [--warmup N] [--script FILE] [--timeout S] [--min-cycles-per-second R] [--max-rss-growth MB]
+
+`startup` launches the agent with its curses UI in a pseudo-terminal N times and reports,
+measured from process launch, when the first frame was drawn, when the saved state had
+loaded, when the model client was ready and when the first API call was issued. Each run
+starts in a fresh temporary directory, or in a copy of DIR to include the cost of loading
+real state. With --max-* set, the exit status is 1 when a median exceeds its budget, so
+the benchmark can gate changes.
+
+`loop` runs the agent loop headless in this process against a ReplayBackend, so it needs no
+API key or network. The default script is generated to mix the common tools with a repairable
+and an unrepairable malformed response, a stream that breaks off and a simulated 429; --script
+replays a recorded or hand-written one instead. After --warmup cycles it measures cycles per
+second, latency per tool, resident memory growth per 1000 cycles, and the time save_state and
+load_state take on the state the run built up. --min-cycles-per-second and --max-rss-growth gate
+the same way.
+"""
+import argparse
+import fcntl
+import json
+import os
+import pty
+import select
+import shutil
+import signal
+import statistics
+import struct
+import sys
+import tempfile
+import termios
+import time
+
+AGENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gemini.py")
+STARTUP_MILESTONES = ("first_frame", "state_loaded", "model_ready", "first_api_call")
+TERMINAL_SIZE = (40, 120) # Rows and columns of the pseudo-terminal the UI draws into
+EXIT_GRACE = 5.0 # Seconds an agent gets to shut down after SIGINT before it is killed
+LOOP_SCRIPT_RESPONSES = 100 # Responses in the generated loop script; longer runs play it again from the top
+MEMORY_SAMPLE_EVERY = 100 # Cycles between resident memory samples
+STATE_TIMING_RUNS = 3 # save_state and load_state are each timed this many times after the loop
+
+def _read_trace(trace_path, launched):
+    """Returns {milestone: milliseconds since launch} for the milestones recorded so far."""
+    times = {}
+    try:
+        with open(trace_path, 'r') as f:
+            for line in f:
+                try: record = json.loads(line)
+                except json.JSONDecodeError: break # Still being written
+                times.setdefault(record["milestone"], (record["time"] - launched) * 1000)
+    except FileNotFoundError:
+        pass
+    return times
+
+def _stop(pid):
+    os.kill(pid, signal.SIGINT)
+    deadline = time.monotonic() + EXIT_GRACE
+    while time.monotonic() < deadline:
+        if os.waitpid(pid, os.WNOHANG)[0]: return
+        time.sleep(0.05)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+def run_startup_once(state_dir, timeout):
+    workdir = tempfile.mkdtemp(prefix="agent-benchmark-")
+    try:
+        if state_dir: shutil.copytree(state_dir, workdir, dirs_exist_ok=True)
+        trace_path = os.path.join(workdir, "startup_trace.jsonl")
+        env = dict(os.environ, AGENT_STARTUP_TRACE=trace_path, TERM=os.environ.get("TERM", "xterm"))
+        env.setdefault("GOOGLE_API_KEY", "benchmark") # The first API call is timed when it is issued, so any key will do
+        launched = time.time()
+        pid, fd = pty.fork()
+        if pid == 0:
+            os.chdir(workdir)
+            os.execve(sys.executable, [sys.executable, AGENT], env)
+        fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack("HHHH", *TERMINAL_SIZE, 0, 0))
+        times = {}
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline and not all(name in times for name in STARTUP_MILESTONES):
+                readable, _, _ = select.select([fd], [], [], 0.05)
+                if readable:
+                    try: os.read(fd, 65536) # Keep the pty drained so the UI never blocks on output
+                    except OSError: break # The agent exited
+                times = _read_trace(trace_path, launched)
+        finally:
+            _stop(pid)
+            os.close(fd)
+        return times
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def benchmark_startup(args):
+    runs = []
+    for i in range(args.runs):
+        times = run_startup_once(args.state, args.timeout)
+        runs.append(times)
+        print(f"run {i + 1}: " + ", ".join(f"{name} {times[name]:.0f} ms" if name in times else f"{name} not reached" for name in STARTUP_MILESTONES), flush=True)
+    print(f"\n{'milestone':<16}{'median':>10}{'min':>10}{'max':>10}  (ms since launch, {args.runs} run(s))")
+    medians = {}
+    for name in STARTUP_MILESTONES:
+        values = [times[name] for times in runs if name in times]
+        if not values:
+            print(f"{name:<16}{'not reached':>30}")
+            continue
+        medians[name] = statistics.median(values)
+        missing = f"  ({args.runs - len(values)} run(s) did not reach it)" if len(values) < args.runs else ""
+        print(f"{name:<16}{medians[name]:>10.0f}{min(values):>10.0f}{max(values):>10.0f}{missing}")
+    failed = False
+    for name, budget in (("first_frame", args.max_first_frame), ("first_api_call", args.max_first_api_call)):
+        if budget is None: continue
+        if medians.get(name, float("inf")) > budget:
+            print(f"FAIL: median {name} exceeds its budget of {budget:.0f} ms")
+            failed = True
+    return 1 if failed else 0
+
+def write_loop_script(path, responses=LOOP_SCRIPT_RESPONSES):
+    """Writes a replay script that cycles through the common tools, with two malformed responses, a broken stream and a 429."""
+    actions = [
+        [{"name": "execute_command", "parameters": {"command": "echo benchmark"}}],
+        [{"name": "write_to_file", "parameters": {"file_path": "notes.txt", "content": "benchmark notes\n" * 50}},
+         {"name": "read_from_file", "parameters": {"file_path": "notes.txt"}}],
+        [{"name": "execute_command", "parameters": {"command": "seq 1 20000"}}, {"name": "list_tasks", "parameters": {}}],
+        [{"name": "check_task_result", "parameters": {"task_name": "task_1"}}],
+        [{"name": "send_user_message", "parameters": {"message": "Still benchmarking."}}],
+        [{"name": "wait_seconds", "parameters": {"seconds": 0}}],
+    ]
+    with open(path, 'w') as f:
+        for i in range(responses):
+            response = {"thought": f"Benchmark step {i}. " * 5, "action": actions[i % len(actions)]}
+            if i == responses // 4: entry = {"text": "Here it is:\n```json\n" + json.dumps(response)[:-1] + ",}\n```"}
+            elif i == responses // 2: entry = {"text": "I will run ls next."}
+            elif i == responses * 3 // 4:
+                text = json.dumps(response)
+                entry = {"text": text[:len(text) // 2], "stream_error": "Stream interrupted (simulated).", "retry_after": 0}
+            elif i == responses - 1: entry = {"error": "429 Resource has been exhausted (simulated).", "status": 429, "retry_after": 0}
+            else: entry = {"response": response}
+            f.write(json.dumps(entry) + "\n")
+
+def _rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def _histogram_summary(histogram):
+    """Returns (count, mean in ms, upper bound of the p95 bucket in ms) of a metrics histogram."""
+    count = histogram["count"]
+    p95 = next((bound for bound, seen in zip(histogram["buckets"], histogram["counts"]) if seen >= 0.95 * count), float("inf"))
+    return count, histogram["sum"] / count * 1000, p95 * 1000
+
+def benchmark_loop(args):
+    script = os.path.abspath(args.script) if args.script else None
+    workdir = tempfile.mkdtemp(prefix="agent-benchmark-")
+    try:
+        os.chdir(workdir)
+        if not script:
+            script = os.path.join(workdir, "loop_script.jsonl")
+            write_loop_script(script)
+        sys.path.insert(0, os.path.dirname(AGENT))
+        import gemini
+        gemini.host.backend = gemini.ReplayBackend(script)
+        gemini.host.rate_limiter = gemini.RateLimiter(10**9, 10**9) # The script stands in for the API, so there is no quota to keep to
+        gemini.IDLE_CYCLE_INTERVAL = 0 # Scripted batches that only wait or talk would otherwise idle for a minute each
+        session = gemini.host.start(gemini.DEFAULT_SESSION)
+        cycles = lambda: gemini.metrics.counters.get(("agent_cycles_total", ()), 0)
+        deadline = time.monotonic() + args.timeout
+        while cycles() < args.warmup and time.monotonic() < deadline: time.sleep(0.01)
+        started, start_cycles, start_rss = time.perf_counter(), cycles(), _rss_bytes()
+        peak_rss, next_sample = start_rss, start_cycles + MEMORY_SAMPLE_EVERY
+        while cycles() < start_cycles + args.cycles and time.monotonic() < deadline:
+            if cycles() >= next_sample:
+                peak_rss, next_sample = max(peak_rss, _rss_bytes()), next_sample + MEMORY_SAMPLE_EVERY
+            time.sleep(0.01)
+        # Taking the chat lock parks the agent before its next API call, so the numbers below stay put.
+        # It is never released: the process exits once the benchmark returns.
+        session.chat_lock.acquire()
+        elapsed, measured, end_rss = time.perf_counter() - started, cycles() - start_cycles, _rss_bytes()
+        counters = dict(gemini.metrics.counters)
+        histograms = {key: dict(value) for key, value in gemini.metrics.histograms.items()}
+        save_times = []
+        for _ in range(STATE_TIMING_RUNS):
+            save_started = time.perf_counter()
+            gemini.save_state(session)
+            save_times.append(time.perf_counter() - save_started)
+        snapshot_bytes = os.path.getsize(session.snapshot_file)
+        load_times = []
+        for i in range(STATE_TIMING_RUNS):
+            reloaded = gemini.AgentSession(f"reload_{i}", gemini.host)
+            os.makedirs(reloaded.state_dir)
+            shutil.copy(session.snapshot_file, reloaded.snapshot_file)
+            load_started = time.perf_counter()
+            gemini.load_state(reloaded)
+            load_times.append(time.perf_counter() - load_started)
+            reloaded.journal.close()
+
+        print(f"{measured} cycles in {elapsed:.1f} s after {start_cycles} warmup cycles: {measured / elapsed:.1f} cycles/s")
+        print(f"responses repaired {counters.get(('agent_repaired_responses_total', ()), 0)}, "
+              f"malformed {counters.get(('agent_malformed_responses_total', ()), 0)}, "
+              f"API errors {counters.get(('agent_api_errors_total', ()), 0)} (whole run)")
+        rss_growth = (end_rss - start_rss) / 2**20 / max(measured, 1) * 1000
+        print(f"resident memory {start_rss / 2**20:.1f} MB -> {end_rss / 2**20:.1f} MB (peak sampled {max(peak_rss, end_rss) / 2**20:.1f} MB), "
+              f"{rss_growth:+.2f} MB per 1000 cycles")
+        print(f"save_state {statistics.median(save_times) * 1000:.1f} ms, load_state {statistics.median(load_times) * 1000:.1f} ms "
+              f"(median of {STATE_TIMING_RUNS}, snapshot {snapshot_bytes / 1024:.0f} KB, {len(session.chat_session.history)} turns)")
+        periodic = histograms.get(("agent_save_state_seconds", ()))
+        if periodic: print("periodic save_state during the run: {} save(s), mean {:.1f} ms".format(*_histogram_summary(periodic)[:2]))
+        print(f"\n{'tool':<26}{'calls':>8}{'mean ms':>10}{'p95 ms <=':>11}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name != "agent_tool_latency_seconds": continue
+            count, mean, p95 = _histogram_summary(histogram)
+            print(f"{dict(labels)['tool']:<26}{count:>8}{mean:>10.2f}{p95:>11.0f}")
+        for name in ("agent_cycle_seconds", "agent_api_latency_seconds", "agent_first_action_seconds"):
+            if (name, ()) in histograms:
+                count, mean, p95 = _histogram_summary(histograms[(name, ())])
+                print(f"{name:<26}{count:>8}{mean:>10.2f}{p95:>11.0f}")
+
+        failed = measured < args.cycles
+        if failed: print(f"FAIL: only {measured} of {args.cycles} cycles ran within {args.timeout:.0f} s")
+        if args.min_cycles_per_second is not None and measured / elapsed < args.min_cycles_per_second:
+            print(f"FAIL: {measured / elapsed:.1f} cycles/s is below the minimum of {args.min_cycles_per_second}")
+            failed = True
+        if args.max_rss_growth is not None and rss_growth > args.max_rss_growth:
+            print(f"FAIL: memory grew {rss_growth:.2f} MB per 1000 cycles, more than {args.max_rss_growth}")
+            failed = True
+        return 1 if failed else 0
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the agent in gemini.py.")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+    startup = benchmarks.add_parser("startup", help="Time-to-first-frame and time-to-first-API-call of the UI.")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--state", help="Directory whose agent state files each run starts from (default: no state).")
+    startup.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for every milestone per run.")
+    startup.add_argument("--max-first-frame", type=float, metavar="MS", help="Fail if the median time to first frame exceeds MS.")
+    startup.add_argument("--max-first-api-call", type=float, metavar="MS", help="Fail if the median time to first API call exceeds MS.")
+    loop = benchmarks.add_parser("loop", help="Throughput, tool latency, memory growth and state save/load time of the agent loop, offline.")
+    loop.add_argument("--cycles", type=int, default=2000, help="Cycles to measure after the warmup.")
+    loop.add_argument("--warmup", type=int, default=100)
+    loop.add_argument("--script", help="ReplayBackend script to play (default: a generated mix of tools and malformed responses).")
+    loop.add_argument("--timeout", type=float, default=600.0, help="Seconds the whole run may take.")
+    loop.add_argument("--min-cycles-per-second", type=float, metavar="R", help="Fail if fewer than R cycles per second were measured.")
+    loop.add_argument("--max-rss-growth", type=float, metavar="MB", help="Fail if resident memory grew more than MB per 1000 cycles.")
+    args = parser.parse_args()
+    sys.exit(benchmark_startup(args) if args.benchmark == "startup" else benchmark_loop(args))
@@ -1,4 +1,3 @@
-import google.generativeai as genai
 import os
 import subprocess
 import json
@@ -8,142 +7,1624 @@ import threading
 from collections import deque
 import curses
 import textwrap
+import selectors
+import mmap
+import random
+import re
+import select
+import signal
+import heapq
+import bisect
+import shlex
+from collections import OrderedDict
+import contextlib
+import asyncio
+import contextvars
+import gzip
+import hashlib
+import tempfile
+import io
+import inspect
+from stat import S_ISREG
+import argparse
+import socket
+import cProfile
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, wait as wait_for_futures
+try:
+    import zstandard # Optional: faster, tighter compression for the blob store
+except ImportError:
+    zstandard = None
 
-# --- Global Thread-Safe State ---
-user_to_agent_queue = deque()
-agent_to_user_queue = deque()
-log_history = deque(maxlen=200)
-chat_history = deque(maxlen=200) # For UI display only
-background_tasks = {}
-task_counter = 0
-MEMORY_FILE = "agent_memory.json"
+# --- Sessions and Their State Files ---
+DEFAULT_SESSION = "default" # Keeps its files in the working directory, as a single-agent process always has
+SESSIONS_DIR = "agent_sessions" # Every other session keeps its files in SESSIONS_DIR/<name>
+SESSION_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+HISTORY_LINES = 200 # Log and chat lines kept per session for the UI
+MEMORY_FILE = "agent_memory.json" # Legacy full-rewrite formats, only read to migrate old sessions
 TASKS_FILE = "agent_tasks.json"
+JOURNAL_FILE = "agent_journal.jsonl"
+SNAPSHOT_FILE = "agent_snapshot.json"
+JOURNAL_FSYNC_INTERVAL = 0.5 # Seconds between batched fsyncs of the journal
+JOURNAL_FSYNC_BATCH = 64 # Pending records that force an fsync before the interval elapses
+JOURNAL_COMPACT_BYTES = 8 * 1024 * 1024 # Journal size that triggers a snapshot and truncation
+LOAD_PROGRESS_INTERVAL = 0.5 # Seconds between progress lines while a large journal is replayed
+TASK_OUTPUT_DIR = "agent_task_output"
+OUTPUT_RING_BYTES = 64 * 1024 # In-memory tail kept per task stream
+OUTPUT_READ_BYTES = 16 * 1024 # Max bytes per stream returned by one check_task_result call
+BLOB_DIR = "agent_blobs" # Content-addressed, compressed store for large task outputs, shared by all sessions
+BLOB_INLINE_BYTES = 8 * 1024 # Finished task streams up to this size stay inline in task records and prompts
+BLOB_PREVIEW_BYTES = 2 * 1024 # Head and tail kept in the record of a stream moved to the blob store
+BLOB_READ_BYTES = 16 * 1024 # Max bytes returned by one read_blob call
+BLOB_GRACE_SECONDS = 3600 # Unreferenced blobs younger than this survive a sweep, so ids still in the conversation stay readable
+BLOB_SWEEP_INTERVAL = 600 # Min seconds between sweeps for blobs that no task record refers to
+MAX_RUNNING_TASKS = 4 # Commands one session runs at once; further commands wait in its priority queue
+MAX_RUNNING_PROCESSES = 8 # Task processes running at once across all sessions of the host
+MAX_FINISHED_TASKS = 200 # Finished tasks kept before the least recently used are evicted
+DEFAULT_TASK_TIMEOUT = 1800 # Wall-clock seconds before a task is killed; 0 disables the limit
+TASK_RLIMIT_CPU_SECONDS = 1800 # Per-task limits applied with ulimit; None leaves a limit unset
+TASK_RLIMIT_MEMORY_BYTES = 4 * 1024 ** 3
+TASK_RLIMIT_OPEN_FILES = 1024
+SHELL_POOL_ENABLED = os.getenv("AGENT_SHELL_POOL") == "1" # Opt-in: run tasks on persistent per-session shells
+SHELL_POOL_SHELL = "/bin/bash"
+SHELL_POOL_IDLE = 2 # Idle shells kept per session; busier sessions start more and close the extras
+SHELL_STARTUP_TIMEOUT = 10 # Seconds a new shell gets to answer its first sentinel
+RESULT_CACHE_ENABLED = os.getenv("AGENT_RESULT_CACHE") == "1" # Opt-in memoisation of read-only tool calls
+RESULT_CACHE_MAX_ENTRIES = 512
+COMMAND_CACHE_TTL = 30 # Seconds a read-only command's result is reused
+FILE_CACHE_TTL = 300 # Seconds an unchanged file read is answered with a reference instead of the content
+CACHEABLE_COMMANDS = {"ls", "cat", "head", "tail", "wc", "stat", "file", "uname", "hostname", "whoami", "id", "pwd",
+                      "which", "df", "du", "lsb_release", "getconf", "nproc", "arch", "lscpu", "lsblk", "dpkg", "printenv"}
 
-# --- Globals for Memory Persistence ---
-chat_session = None
-chat_lock = threading.Lock()
-state_lock = threading.Lock() # For saving tasks and memory
+# --- Task Output and File Reading ---
+EXIT_DRAIN_GRACE = 1.0 # Seconds to keep draining pipes after a task exits before recording its result
+READ_CHUNK_BYTES = 32 * 1024 # Max bytes returned by one read_from_file call
+READ_MMAP_THRESHOLD = 1024 * 1024 # Files at least this large are memory-mapped instead of read
+READ_UNSIZED_BYTES = 8 * 1024 * 1024 # Most read from files with no size on record (procfs, sysfs, devices)
+READ_BINARY_SNIFF = 8192 # Leading bytes inspected for NUL when detecting binary files
+READ_HEXDUMP_BYTES = 2048 # Max bytes shown per call for binary files
+LINE_INDEX_FILES = 16 # Large files whose newline counts are kept, so paging through one never rescans it from the start
+
+# --- Cycle Scheduling ---
+MODEL_NAME = "gemma-3-27b-it"
+MODEL_REQUESTS_PER_MINUTE = 30 # Request quota of the configured model, shared by all sessions
+MODEL_REQUEST_BURST = 3 # Requests that may be sent back-to-back before the quota rate applies
+IDLE_CYCLE_INTERVAL = 60 # Seconds between self-directed cycles when there is nothing to do
+IDLE_ACTIONS = ("finish_task", "wait_seconds", "send_user_message") # A batch of only these, with no task pending, leaves the agent idle
+BACKOFF_BASE = 2.0 # First retry delay after a failed API call, doubled per consecutive failure
+BACKOFF_MAX = 300.0
+
+# --- Context Window ---
+CONTEXT_TOKEN_BUDGET = 120_000 # Estimated history tokens above which old turns are summarised
+CONTEXT_COMPACT_TARGET = 0.5 # Fraction of the budget the history is compacted down to
+CONTEXT_PINNED_TURNS = 2 # Instruction prompt and its acknowledgement are never compacted
+CONTEXT_KEEP_RECENT_TURNS = 12 # Most recent turns are always kept verbatim
+CHARS_PER_TOKEN = 4 # Rough estimate used instead of a count_tokens round-trip
+TOOL_RESULT_MAX_CHARS = 40_000 # Cap for one TOOL_RESULT block in the outgoing message
+TOOL_RESULT_PREVIEW_CHARS = 1_500 # Size TOOL_RESULT blocks shrink to once they fall out of the recent turns
+SUMMARY_INPUT_CHARS = 200_000 # Max transcript characters handed to the summariser
+
+# --- Action Dispatch ---
+ACTION_WORKERS = 8 # Threads per session running the independent actions of one model response
+STREAM_RESPONSES = os.getenv("AGENT_STREAM_RESPONSES", "1") == "1" # Stream model output and start each action as soon as it is parsed
+THOUGHT_LOG_CHARS = 160 # A streamed thought is logged in pieces of about this size, split at sentence ends
+REPLAY_CHUNK_CHARS = 64 # Characters per chunk when a --replay response is streamed
+
+# --- Local Socket API ---
+AGENT_SOCKET = "agent.sock" # Unix socket the agent serves its JSON-lines API on
+API_LINE_LIMIT = 1024 * 1024 # Longest request line accepted from a client
+API_STREAMS = ("log", "chat", "task") # Event streams a client can subscribe to
+SUBSCRIBER_QUEUE_SIZE = 1000 # Events buffered per slow client before the oldest are dropped
+UI_IDLE_TIMEOUT = 1.0 # Longest the UI sleeps without input or changes
+
+# --- Metrics and Profiling ---
+METRICS_PORT = int(os.getenv("AGENT_METRICS_PORT", "0")) # Serve Prometheus text on 127.0.0.1:PORT/metrics when set
+METRICS_FILE = os.getenv("AGENT_METRICS_FILE") # Rewrite this file with Prometheus text every METRICS_FILE_INTERVAL when set
+METRICS_FILE_INTERVAL = 15
+PROFILE_AGENT = os.getenv("AGENT_PROFILE") == "1" # cProfile + tracemalloc the agent thread
+PROFILE_FILE = "agent_profile.pstats"
+PROFILE_DUMP_EVERY = 20 # Cycles between profile dumps
+STARTUP_TRACE_FILE = os.getenv("AGENT_STARTUP_TRACE") # Append startup milestones here as JSON lines when set (see benchmark.py)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# --- Event Hub ---
+
+class EventHub:
+    """Fans log, chat and task events out from any thread to the listeners on the server's event loop."""
+    def __init__(self):
+        self.loop = None
+        self.listeners = []
+
+    def attach(self, loop):
+        self.loop = loop
+
+    def publish(self, event):
+        loop = self.loop
+        if loop is None: return # No server running; the deques still hold the history for later subscribers
+        try: loop.call_soon_threadsafe(self._dispatch, event)
+        except RuntimeError: pass # Loop already closed during shutdown
+
+    def _dispatch(self, event):
+        for listener in list(self.listeners): listener(event)
+
+event_hub = EventHub()
 
 # --- Curses-Safe Logging ---
 def log_message(message):
-    """Appends a message to the log history for display in the UI."""
-    log_history.append(f"[{time.strftime('%H:%M:%S')}] {message}")
+    """Appends a message to the current session's log history and publishes it to subscribed clients."""
+    _session().log(message)
 
-# --- Persistence Functions ---
+# --- Metrics ---
+
+class Metrics:
+    """Thread-safe counters, histograms and callback gauges rendered in Prometheus text format."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def describe(self, name, kind, help_text):
+        self.help[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None: histogram = self.histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound: histogram["counts"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def gauge(self, name, read_value):
+        self.gauges[name] = read_value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = []
+        described = set()
+        def header(name, fallback_kind):
+            if name in described: return
+            described.add(name)
+            kind, help_text = self.help.get(name, (fallback_kind, name))
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"])
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(value, counts=list(value["counts"]))) for key, value in self.histograms.items())
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            header(name, "histogram")
+            for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', repr(float(bound))),))} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+        for name, read_value in sorted(self.gauges.items()):
+            try: value = read_value()
+            except Exception: continue
+            header(name, "gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels):
+    if not labels: return ""
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels) + "}"
+
+metrics = Metrics()
+for _name, _kind, _help in (
+    ("agent_cycles_total", "counter", "Agent loop cycles that sent a request to the model."),
+    ("agent_cycle_seconds", "histogram", "Wall time of one agent cycle, from request to tool results."),
+    ("agent_scheduler_wait_seconds", "histogram", "Time spent waiting for the scheduler before a cycle."),
+    ("agent_api_latency_seconds", "histogram", "Latency of send_message calls to the model."),
+    ("agent_api_request_bytes", "histogram", "Size of the message sent to the model each cycle."),
+    ("agent_api_response_bytes", "histogram", "Size of the model's response text."),
+    ("agent_api_errors_total", "counter", "Failed model API calls."),
+    ("agent_first_action_seconds", "histogram", "Time from sending a request to dispatching the first action of its response."),
+    ("agent_malformed_responses_total", "counter", "Model responses that could not be parsed and needed a recovery round-trip."),
+    ("agent_repaired_responses_total", "counter", "Model responses that were repaired locally instead of needing a recovery round-trip."),
+    ("agent_response_repairs_total", "counter", "Repairs applied to model responses, by kind of repair."),
+    ("agent_tool_latency_seconds", "histogram", "Latency of tool calls by tool name."),
+    ("agent_tool_errors_total", "counter", "Tool calls that returned an error, by tool name."),
+    ("agent_tasks_started_total", "counter", "Background task processes started."),
+    ("agent_tasks_finished_total", "counter", "Background tasks finished, by final status."),
+    ("agent_task_queue_depth", "gauge", "Background tasks waiting for a free slot, summed over sessions."),
+    ("agent_running_processes", "gauge", "Background task processes currently running across all sessions."),
+    ("agent_save_state_seconds", "histogram", "Time to write a state snapshot and truncate the journal."),
+    ("agent_load_state_seconds", "histogram", "Time to restore a session from its snapshot and journal."),
+    ("agent_history_tokens", "gauge", "Estimated tokens in the chat history, summed over sessions."),
+    ("agent_sessions", "gauge", "Agent sessions hosted by this process."),
+):
+    metrics.describe(_name, _kind, _help)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Keep request logs out of the curses screen
+
+def _write_metrics_file_loop():
+    while True:
+        try:
+            tmp_path = METRICS_FILE + ".tmp"
+            with open(tmp_path, 'w') as f: f.write(metrics.render())
+            os.replace(tmp_path, METRICS_FILE)
+        except OSError as e:
+            log_message(f"Error writing metrics file: {e}")
+        time.sleep(METRICS_FILE_INTERVAL)
+
+def start_metrics_exporters():
+    if METRICS_PORT:
+        server = ThreadingHTTPServer(("127.0.0.1", METRICS_PORT), _MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        log_message(f"Serving metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+    if METRICS_FILE:
+        threading.Thread(target=_write_metrics_file_loop, daemon=True).start()
+        log_message(f"Writing metrics to {METRICS_FILE} every {METRICS_FILE_INTERVAL} second(s).")
+
+class AgentProfiler:
+    """cProfile and tracemalloc for the agent thread, dumped every PROFILE_DUMP_EVERY cycles."""
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.cycles = 0
+
+    def start(self):
+        tracemalloc.start()
+        self.profile.enable() # cProfile only profiles the thread that enables it
+        log_message(f"Profiling the agent thread; stats go to {PROFILE_FILE}.")
+
+    def cycle_done(self):
+        self.cycles += 1
+        if self.cycles % PROFILE_DUMP_EVERY: return
+        self.profile.dump_stats(PROFILE_FILE)
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics("lineno")[:3]
+        log_message(f"Profile dumped. Traced memory {current / 1e6:.1f} MB (peak {peak / 1e6:.1f} MB); top allocations: " + "; ".join(str(stat) for stat in top))
+
+# --- Blob Store ---
+
+class BlobStore:
+    """Content-addressed store for large outputs, compressed with zstd when available, else gzip.
+
+    A blob is named by the SHA-256 of its uncompressed content, so identical outputs are
+    stored once however many tasks produced them. Blobs are never rewritten, so readers
+    need no locking. `sweep` deletes blobs that no task record refers to any more.
+    """
+    def __init__(self, root=BLOB_DIR):
+        self.root = root
+        self.lock = threading.Lock() # Keeps a sweep from deleting a blob that put_file is reusing
+        self.last_sweep = 0.0
+
+    def _path(self, blob_id, extension):
+        return os.path.join(self.root, blob_id[:2], blob_id + extension)
+
+    def _find(self, blob_id):
+        if not BLOB_ID_PATTERN.fullmatch(blob_id): return None
+        for extension in (".zst", ".gz"):
+            if os.path.exists(self._path(blob_id, extension)): return self._path(blob_id, extension)
+        return None
+
+    def put_file(self, source_path):
+        """Stores the content of `source_path`. Returns (blob id, size in bytes, line count)."""
+        digest, size, newlines, last = hashlib.sha256(), 0, 0, b""
+        with open(source_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+                size += len(chunk)
+                newlines += chunk.count(b"\n")
+                last = chunk[-1:]
+        blob_id = digest.hexdigest()
+        lines = newlines + (1 if last not in (b"", b"\n") else 0)
+        with self.lock:
+            existing = self._find(blob_id)
+            if existing:
+                os.utime(existing) # Restarts its grace period, as for a new blob
+                return blob_id, size, lines # Already stored; skip compressing it again
+        extension = ".zst" if zstandard else ".gz"
+        os.makedirs(os.path.dirname(self._path(blob_id, extension)), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with open(source_path, 'rb') as src, os.fdopen(fd, 'wb') as raw:
+                if zstandard: out = zstandard.ZstdCompressor(level=3).stream_writer(raw, size=size, closefd=False)
+                else: out = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6, mtime=0)
+                with out:
+                    for chunk in iter(lambda: src.read(1024 * 1024), b""): out.write(chunk)
+            os.replace(tmp_path, self._path(blob_id, extension))
+        except BaseException:
+            with contextlib.suppress(OSError): os.remove(tmp_path)
+            raise
+        return blob_id, size, lines
+
+    def read(self, blob_id, offset, length):
+        """Returns up to `length` uncompressed bytes of a blob starting at `offset`."""
+        path = self._find(blob_id)
+        if path is None: raise FileNotFoundError(f"No blob with id '{blob_id}'")
+        if path.endswith(".zst") and not zstandard: raise RuntimeError(f"Blob '{blob_id}' is zstd-compressed but the zstandard module is not installed")
+        with open(path, 'rb') as raw:
+            src = zstandard.ZstdDecompressor().stream_reader(raw) if path.endswith(".zst") else gzip.GzipFile(fileobj=raw, mode='rb')
+            with src:
+                _read_exactly(src, offset) # Compressed streams only seek by decompressing, so skip forward
+                return _read_exactly(src, length)
+
+    def sweep(self, referenced, grace=BLOB_GRACE_SECONDS):
+        """Deletes blobs not in `referenced` and leftover temporary files older than `grace` seconds.
+
+        Returns (files removed, bytes freed).
+        """
+        removed, freed = 0, 0
+        if not os.path.isdir(self.root): return removed, freed
+        cutoff = time.time() - grace
+        for dir_path, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                blob_id, extension = os.path.splitext(file_name)
+                if extension not in (".zst", ".gz", ".tmp") or blob_id in referenced: continue
+                path = os.path.join(dir_path, file_name)
+                with self.lock:
+                    try:
+                        stat = os.stat(path)
+                        if stat.st_mtime > cutoff: continue
+                        os.remove(path)
+                    except OSError: continue
+                removed, freed = removed + 1, freed + stat.st_size
+        return removed, freed
+
+BLOB_ID_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+def _read_exactly(f, length):
+    chunks = []
+    while length > 0:
+        chunk = f.read(min(length, 1024 * 1024))
+        if not chunk: break
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b"".join(chunks)
+
+_traced_milestones = set()
+
+def _trace_startup(milestone):
+    """Records the first time this process reaches `milestone` when STARTUP_TRACE_FILE is set."""
+    if not STARTUP_TRACE_FILE or milestone in _traced_milestones: return
+    _traced_milestones.add(milestone)
+    with open(STARTUP_TRACE_FILE, 'a') as f: f.write(json.dumps({"milestone": milestone, "time": time.time()}) + "\n")
+
+# --- Streaming Task Output ---
+
+class OutputStream:
+    """Keeps the most recent bytes of a task stream in memory and spills the full stream to disk."""
+    def __init__(self, spill_path, ring_bytes=OUTPUT_RING_BYTES):
+        self.lock = threading.Lock()
+        self.spill_path = spill_path
+        self.ring_bytes = ring_bytes
+        self.ring = bytearray()
+        self.ring_start = 0 # Absolute offset of ring[0]
+        self.total = 0
+        self.spill = open(spill_path, 'wb')
+        self.archived = None # (BlobStore, blob id) once the spill file has moved to the blob store
+        self.lines = None
+
+    def write(self, data):
+        with self.lock:
+            self.spill.write(data)
+            self.ring += data
+            self.total += len(data)
+            overflow = len(self.ring) - self.ring_bytes
+            if overflow > 0:
+                del self.ring[:overflow]
+                self.ring_start += overflow
 
-def save_state():
-    with state_lock:
-        if chat_session:
-            log_message(f"Saving memory to {MEMORY_FILE}...")
-            history_to_save = [{"role": item.role, "parts": [{"text": item.parts[0].text}]} for item in chat_session.history]
+    def close(self):
+        with self.lock:
+            if not self.spill.closed: self.spill.close()
+
+    def archive(self, store):
+        """Moves the closed spill file into `store`. Reads before the ring then come from the blob."""
+        blob_id, _, lines = store.put_file(self.spill_path)
+        with self.lock: self.archived, self.lines = (store, blob_id), lines
+        os.remove(self.spill_path)
+
+    def read(self, offset, limit=OUTPUT_READ_BYTES):
+        """Returns (data, start, end) for up to `limit` bytes starting at absolute `offset`."""
+        with self.lock:
+            start = max(0, min(offset, self.total))
+            end = min(self.total, start + limit)
+            if start >= self.ring_start:
+                return bytes(self.ring[start - self.ring_start:end - self.ring_start]), start, end
+            if not self.spill.closed: self.spill.flush()
+            archived = self.archived
+        if archived is None:
+            try:
+                with open(self.spill_path, 'rb') as f:
+                    f.seek(start)
+                    return f.read(end - start), start, end
+            except FileNotFoundError:
+                archived = self.archived # Archived while this read was on its way
+                if archived is None: raise
+        store, blob_id = archived
+        return store.read(blob_id, start, end - start), start, end
+
+def _format_stream(label, stream, offset):
+    """Renders one stream slice with its byte offsets.
+
+    A None offset shows the most recent output, or only a head/tail preview once the stream
+    has been archived to the blob store.
+    """
+    if offset is None and stream.archived: return _format_archived_stream(label, stream)
+    if offset is None: offset = max(0, stream.total - OUTPUT_READ_BYTES)
+    data, start, end = stream.read(offset)
+    header = f"{label} [bytes {start}-{end} of {stream.total}]"
+    notes = []
+    if start > 0: notes.append(f"earlier output from {label.lower()}_offset=0")
+    if end < stream.total: notes.append(f"more output from {label.lower()}_offset={end}")
+    if notes: header += f" ({'; '.join(notes)}; " + (f"full output in blob {stream.archived[1]})" if stream.archived else f"full log at {stream.spill_path})")
+    return f"{header}:\n{data.decode('utf-8', errors='replace')}"
+
+def _format_archived_stream(label, stream):
+    head = stream.read(0, BLOB_PREVIEW_BYTES)[0]
+    tail = stream.read(max(len(head), stream.total - BLOB_PREVIEW_BYTES), BLOB_PREVIEW_BYTES)[0]
+    header = (f"{label} [{stream.total} bytes, {stream.lines} lines; full output in blob {stream.archived[1]}, "
+              f"read more with read_blob or {label.lower()}_offset]")
+    elided = stream.total - len(head) - len(tail)
+    return f"{header}:\n{head.decode('utf-8', errors='replace')}\n...[{elided} bytes elided]...\n{tail.decode('utf-8', errors='replace')}"
+
+def _task_result_string(task, exit_code, stdout_offset, stderr_offset):
+    streams = task['output']
+    body = f"{_format_stream('STDOUT', streams['stdout'], stdout_offset)}\n{_format_stream('STDERR', streams['stderr'], stderr_offset)}"
+    if exit_code != 0: return f"COMMAND FAILED with exit code {exit_code}:\n{body}"
+    if not streams['stdout'].total and not streams['stderr'].total: return "Command finished successfully with no output."
+    return body
+
+# --- Task Management ---
+
+TASK_DONE_STATES = ('finished', 'interrupted', 'cancelled', 'timed_out')
+
+def _rlimit_prefix():
+    limits = []
+    if TASK_RLIMIT_CPU_SECONDS: limits.append(f"ulimit -t {int(TASK_RLIMIT_CPU_SECONDS)}; ")
+    if TASK_RLIMIT_MEMORY_BYTES: limits.append(f"ulimit -v {int(TASK_RLIMIT_MEMORY_BYTES) // 1024}; ")
+    if TASK_RLIMIT_OPEN_FILES: limits.append(f"ulimit -n {int(TASK_RLIMIT_OPEN_FILES)}; ")
+    # Set in the task's own shell rather than with preexec_fn, which is unsafe in a threaded parent.
+    # One option per ulimit call, since dash accepts only one.
+    return "".join(limits)
+
+class TaskManager:
+    """Owns a session's background tasks: naming, queueing, process lifetime, timeouts and eviction.
+
+    At most `max_running` of the session's commands run at once, and only in slots the host's
+    ProcessPool grants; the rest wait in a priority queue (higher priority first, then
+    submission order). Each running task has a pump thread that drains its pipes, kills it
+    when its wall-clock timeout passes and records its result on exit. Finished tasks beyond
+    `max_finished` are evicted least recently used first.
+    """
+    def __init__(self, session, pool, max_running=MAX_RUNNING_TASKS, max_finished=MAX_FINISHED_TASKS):
+        self.session = session
+        self.pool = pool
+        self.lock = threading.Condition() # Notified whenever a task changes state
+        self.tasks = OrderedDict()
+        self.counter = 0
+        self.pending = []
+        self.running = 0
+        self.max_running = max_running
+        self.max_finished = max_finished
+        self.waited_on = {} # Task name -> number of wait() calls for it, which keep it from eviction
+
+    def __contains__(self, task_name):
+        return task_name in self.tasks
+
+    def get(self, task_name):
+        with self.lock:
+            task = self.tasks.get(task_name)
+            if task is not None and task['status'] in TASK_DONE_STATES: self.tasks.move_to_end(task_name)
+            return task
+
+    def submit(self, command, priority=0, timeout=DEFAULT_TASK_TIMEOUT):
+        """Registers a command and starts it now if a slot is free. Returns (task_name, queue position)."""
+        with self.lock:
+            self.counter += 1
+            task_name = f"task_{self.counter}"
+            task = {"command": command, "status": "queued", "result": None, "priority": priority, "timeout": timeout or None,
+                    "proc": None, "output": None, "submitted_at": time.time()}
+            self.tasks[task_name] = task
+            heapq.heappush(self.pending, (-priority, self.counter, task_name))
+            self.session.journal_task(task_name, task)
+        self.pool.request(self) # Outside self.lock: the pool may start tasks of other sessions too
+        with self.lock:
+            return task_name, self._queue_position(task_name)
+
+    def submit_alias(self, command, original_name):
+        """Registers a task that reuses `original_name`'s output instead of running the command again.
+
+        Returns the new task name, or None if the original can no longer stand in for it.
+        """
+        with self.lock:
+            original = self.tasks.get(original_name)
+            if original is None or original['status'] not in ('running', 'finished') or original.get('exit_code', 0) != 0: return None
+            self.counter += 1
+            task_name = f"task_{self.counter}"
+            task = {"command": command, "status": "running", "result": None, "priority": 0, "timeout": None, "proc": None,
+                    "output": None, "alias_of": original_name, "submitted_at": time.time(), "started_at": time.time()}
+            self.tasks[task_name] = task
+            if original['status'] == 'running': original.setdefault('aliases', []).append(task_name)
+            else: self._finish_alias(task_name, task, original)
+            self.session.journal_task(task_name, task)
+            return task_name
+
+    def _finish_alias(self, task_name, task, original):
+        if original['status'] == 'finished' and original['exit_code'] == 0:
+            task['result'] = f"Output unchanged since task '{task['alias_of']}', which ran the identical command; its result still applies."
+        else:
+            task['result'] = f"Same command as task '{task['alias_of']}', which ended with status '{original['status']}':\n{original['result']}"
+        task['status'], task['exit_code'], task['finished_at'] = 'finished', original.get('exit_code'), time.time()
+        self.lock.notify_all()
+
+    def _queue_position(self, task_name):
+        """1-based position of a queued task among the tasks still waiting, or 0 if it is not queued."""
+        if self.tasks[task_name]['status'] != 'queued': return 0
+        entry = next(entry for entry in self.pending if entry[2] == task_name)
+        return 1 + sum(1 for other in self.pending if other < entry and self.tasks.get(other[2], {}).get('status') == 'queued')
+
+    def _start_next(self):
+        """Starts the highest-priority queued task in a slot the pool has reserved for this session.
+
+        Returns (whether a task started, whether the session could use another slot right away).
+        """
+        with self.lock:
+            started = False
+            while not started and self.pending and self.running < self.max_running:
+                _, _, task_name = heapq.heappop(self.pending)
+                task = self.tasks.get(task_name)
+                if task is None or task['status'] != 'queued': continue # Cancelled or evicted while queued
+                try:
+                    self._start(task_name, task)
+                    started = True
+                except Exception as e:
+                    task['status'], task['result'], task['start_failed'] = 'finished', f"ERROR: Failed to execute command. Details: {e}", True
+                    self.session.log(f"Task '{task_name}' failed to start: {e}")
+                    self.session.journal_task(task_name, task)
+                    self.lock.notify_all()
+            return started, bool(self.pending) and self.running < self.max_running
+
+    def _start(self, task_name, task):
+        self.session.log(f"Starting ASYNC command as '{task_name}': {task['command']}")
+        os.makedirs(self.session.task_output_dir, exist_ok=True)
+        shell_pool = self.session.shell_pool
+        proc = None # A pooled shell is picked on the pump thread, since starting one may take a moment
+        if shell_pool is None:
+            proc = subprocess.Popen(_rlimit_prefix() + task['command'], shell=True, stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        task['output'] = {name: OutputStream(path) for name, path in self._output_paths(task_name).items()}
+        task['proc'], task['status'], task['started_at'] = proc, 'running', time.time()
+        self.running += 1
+        metrics.inc("agent_tasks_started_total")
+        self.session.journal_task(task_name, task)
+        task['pump'] = self.session.spawn(self._pump if shell_pool is None else self._pump_shell, task_name, task)
+
+    def _pump(self, task_name, task):
+        """Drains a task's pipes as data arrives and records the result the moment the process exits.
+
+        The process exit is observed through a pidfd registered on the same selector as the pipes,
+        so waiters are woken by the exit itself rather than by polling. The same select timeout
+        enforces the task's wall-clock limit.
+        """
+        proc, streams = task['proc'], task['output']
+        selector = selectors.DefaultSelector()
+        selector.register(proc.stdout, selectors.EVENT_READ, streams['stdout'])
+        selector.register(proc.stderr, selectors.EVENT_READ, streams['stderr'])
+        open_pipes = 2
+        pidfd = None
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+            selector.register(pidfd, selectors.EVENT_READ, None)
+        except (AttributeError, OSError):
+            pidfd = None # No pidfd support: fall back to a short select timeout and proc.poll()
+        kill_deadline = time.monotonic() + task['timeout'] if task['timeout'] else None
+        exit_deadline = None
+        finalized = False
+        try:
+            while open_pipes or not finalized:
+                if finalized: timeout = None
+                elif exit_deadline is not None: timeout = max(0, exit_deadline - time.monotonic())
+                else:
+                    timeout = None if pidfd is not None else 0.05
+                    if kill_deadline is not None: timeout = max(0, min(timeout or kill_deadline, kill_deadline - time.monotonic()))
+                for key, _ in selector.select(timeout):
+                    if key.data is None:
+                        selector.unregister(pidfd); os.close(pidfd); pidfd = None
+                        continue
+                    data = os.read(key.fileobj.fileno(), 65536)
+                    if data:
+                        key.data.write(data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        open_pipes -= 1
+                if finalized: continue
+                if exit_deadline is None and kill_deadline is not None and time.monotonic() >= kill_deadline and proc.poll() is None:
+                    self.session.log(f"Task '{task_name}' exceeded its {task['timeout']} second timeout. Killing it.")
+                    task['status_on_exit'] = 'timed_out'
+                    _kill_process_group(proc)
+                if exit_deadline is None and proc.poll() is not None:
+                    exit_deadline = time.monotonic() + EXIT_DRAIN_GRACE
+                # Record the result once the pipes hit EOF, or after the grace period if something
+                # the command left behind still holds them open (that output keeps being drained).
+                if exit_deadline is not None and (not open_pipes or time.monotonic() >= exit_deadline):
+                    self._finish(task_name, task, proc.wait(), archive=not open_pipes)
+                    finalized = True
+        finally:
+            if pidfd is not None: os.close(pidfd)
+            selector.close()
+            for stream in streams.values(): stream.close()
+
+    def _pump_shell(self, task_name, task):
+        """Runs a task on one of the session's persistent shells and records its result."""
+        def started(proc):
+            with self.lock:
+                task['proc'] = proc
+                return task.get('status_on_exit') != 'cancelled'
+        deadline = time.monotonic() + task['timeout'] if task['timeout'] else None
+        try:
+            exit_code, timed_out = self.session.shell_pool.run(task['command'], task['output'], deadline, started)
+        except Exception as e:
+            task['output']['stderr'].write(f"ERROR: Persistent shell failed: {e}\n".encode())
+            exit_code, timed_out = -1, False
+        if timed_out:
+            self.session.log(f"Task '{task_name}' exceeded its {task['timeout']} second timeout. Killing it.")
+            task['status_on_exit'] = 'timed_out'
+        self._finish(task_name, task, exit_code)
+
+    def _finish(self, task_name, task, exit_code, archive=True):
+        status = task.pop('status_on_exit', 'finished')
+        # Streams still held open by leftover processes keep their spill files instead.
+        if archive: self._archive_output(task_name, task)
+        result = _task_result_string(task, exit_code, None, None)
+        if status == 'timed_out': result = f"TASK TIMED OUT after {task['timeout']} second(s) and was killed.\n{result}"
+        elif status == 'cancelled': result = f"TASK CANCELLED.\n{result}"
+        with self.lock:
+            task['exit_code'], task['result'], task['status'], task['proc'] = exit_code, result, status, None
+            task['finished_at'] = time.time()
+            self.running -= 1
+            self.tasks.move_to_end(task_name)
+            self.session.journal_task(task_name, task)
+            for alias_name in task.pop('aliases', []):
+                alias = self.tasks.get(alias_name)
+                if alias is None or alias['status'] != 'running': continue
+                self._finish_alias(alias_name, alias, task)
+                self.session.journal_task(alias_name, alias)
+            self._evict()
+            self.lock.notify_all()
+            more = bool(self.pending)
+        self.pool.release(self, more)
+        metrics.inc("agent_tasks_finished_total", status=status)
+        self.session.log(f"Task '{task_name}' has {status} with exit code {exit_code}.")
+
+    def _archive_output(self, task_name, task):
+        """Moves large streams to the blob store so the task record keeps only a preview and a blob id."""
+        for stream in task['output'].values():
+            stream.close()
+            if stream.total <= BLOB_INLINE_BYTES: continue
             try:
-                with open(MEMORY_FILE, 'w') as f:
-                    json.dump(history_to_save, f, indent=2)
-                log_message("Memory saved successfully.")
+                stream.archive(self.session.host.blob_store)
             except Exception as e:
-                log_message(f"Error saving memory: {e}")
+                self.session.log(f"Could not move output of task '{task_name}' to the blob store: {e}")
+
+    def _output_paths(self, task_name):
+        return {name: os.path.join(self.session.task_output_dir, f"{task_name}.{name}") for name in ("stdout", "stderr")}
+
+    def _evict(self):
+        finished = [name for name, task in self.tasks.items() if task['status'] in TASK_DONE_STATES and name not in self.waited_on]
+        evicted = finished[:max(0, len(finished) - self.max_finished)]
+        for task_name in evicted:
+            self.tasks.pop(task_name)
+            # By path rather than through the task's streams, which tasks restored from saved state do not have.
+            for path in self._output_paths(task_name).values():
+                try: os.remove(path)
+                except OSError: pass
+            self.session.append_journal({"type": "task_evicted", "name": task_name})
+        if evicted: self.session.host.sweep_blobs_soon() # Their blobs may now be unreferenced
+
+    def blob_ids(self):
+        """Returns the ids of the blobs this session's task records refer to."""
+        ids = set()
+        for task in list(self.tasks.values()):
+            ids.update(BLOB_ID_PATTERN.findall(task['result'] or ""))
+            for stream in (task.get('output') or {}).values():
+                if stream.archived: ids.add(stream.archived[1])
+        return ids
+
+    def cancel(self, task_name):
+        """Cancels a queued or running task. Returns False if it had already finished."""
+        with self.lock:
+            task = self.tasks[task_name]
+            if task.get('alias_of') and task['status'] == 'running':
+                task['status'], task['result'] = 'cancelled', "TASK CANCELLED."
+                self.session.journal_task(task_name, task)
+                self.lock.notify_all()
+                return True
+            if task['status'] == 'queued':
+                task['status'], task['result'] = 'cancelled', "TASK CANCELLED before it started."
+                self.session.journal_task(task_name, task)
+                self.lock.notify_all()
+                return True
+            if task['status'] != 'running': return False
+            task['status_on_exit'] = 'cancelled'
+            if task['proc']: _kill_process_group(task['proc']) # A pooled shell not picked yet sees the flag instead
+            return True
+
+    def wait(self, task_names, wait_all, timeout):
+        """Blocks until any (or all) of the named tasks are done, or until the timeout expires."""
+        deadline = None if timeout is None else time.monotonic() + float(timeout)
+        with self.lock:
+            # Finished tasks in the set stay put until the wait ends, however many others finish meanwhile.
+            for name in task_names: self.waited_on[name] = self.waited_on.get(name, 0) + 1
+            try:
+                while True:
+                    done = [name for name in task_names if name not in self.tasks or self.tasks[name]['status'] in TASK_DONE_STATES]
+                    if len(done) == len(task_names) or (done and not wait_all): return done
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0: return done
+                    self.lock.wait(remaining)
+            finally:
+                for name in task_names:
+                    self.waited_on[name] -= 1
+                    if not self.waited_on[name]: del self.waited_on[name]
+
+    def restore(self, task_name, task):
+        """Adds a task loaded from saved state. Tasks that were in flight are marked interrupted."""
+        with self.lock:
+            task['proc'], task['output'] = None, None
+            if task['status'] in ('running', 'queued'):
+                task['status'] = 'interrupted'
+                task['result'] = "Task was interrupted by agent restart."
+                self.session.journal_task(task_name, task)
+            self.tasks[task_name] = task
+            if task_name.startswith("task_") and task_name[5:].isdigit(): self.counter = max(self.counter, int(task_name[5:]))
+
+    def remove_orphaned_output(self):
+        """Deletes output files in the session's task output directory that no task record owns."""
+        try: file_names = os.listdir(self.session.task_output_dir)
+        except OSError: return
+        with self.lock:
+            owned = {os.path.basename(path) for task_name in self.tasks for path in self._output_paths(task_name).values()}
+        for file_name in file_names:
+            if file_name in owned: continue
+            try: os.remove(os.path.join(self.session.task_output_dir, file_name))
+            except OSError: pass
+
+    def snapshot(self):
+        # Deliberately lock-free: the journal calls this while holding its own lock, and task
+        # methods append to the journal while holding self.lock. Copying the items is atomic.
+        return {name: {"command": task["command"], "status": task["status"], "result": task["result"]} for name, task in list(self.tasks.items())}
+
+    def queued_count(self):
+        return sum(1 for task in list(self.tasks.values()) if task['status'] == 'queued')
+
+    def describe(self):
+        with self.lock:
+            now = time.time()
+            lines = []
+            for name, task in self.tasks.items():
+                if task['status'] == 'running': age = f"running {now - task['started_at']:.1f}s"
+                elif task['status'] == 'queued': age = f"queued #{self._queue_position(name)}"
+                else: age = task['status']
+                command = task['command'] if len(task['command']) <= 80 else task['command'][:77] + "..."
+                lines.append(f"{name}: {age} | priority {task.get('priority', 0)} | {command}")
+            return lines
+
+def _kill_process_group(proc):
+    try: os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError): pass
+
+# --- Persistent Shell Workers ---
 
-        log_message(f"Saving background tasks to {TASKS_FILE}...")
-        tasks_to_save = {name: {"command": task["command"], "status": task["status"], "result": task["result"]} for name, task in background_tasks.items()}
+class _SentinelFramer:
+    """Passes a shell's output through to `sink` up to a sentinel, holding back only what could be part of it."""
+    def __init__(self, sentinel, sink):
+        self.sentinel = sentinel
+        self.sink = sink
+        self.pending = b""
+        self.trailer = None # Everything after the sentinel, once it has been seen
+
+    def feed(self, data):
+        if self.trailer is not None:
+            self.trailer += data
+            return
+        self.pending += data
+        index = self.pending.find(self.sentinel)
+        if index >= 0:
+            self.sink.write(self.pending[:index])
+            self.trailer, self.pending = self.pending[index + len(self.sentinel):], b""
+        elif len(self.pending) >= len(self.sentinel):
+            cut = len(self.pending) - len(self.sentinel) + 1
+            self.sink.write(self.pending[:cut])
+            self.pending = self.pending[cut:]
+
+    def flush(self):
+        if self.pending: self.sink.write(self.pending)
+        self.pending = b""
+
+class ShellWorker:
+    """A long-lived bash that runs task commands one at a time.
+
+    Each command is sent as a short script that evals it with stdin from /dev/null and its
+    output on the shell's original descriptors (so `exec >file` cannot redirect the shell
+    itself), then prints a random sentinel followed by the exit status, working directory,
+    exported variable names and `export -p`. Everything before the sentinel is output.
+    """
+    def __init__(self):
+        self.proc = subprocess.Popen([SHELL_POOL_SHELL, "--noprofile", "--norc"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE, start_new_session=True)
+        self.alive = True
+        self.version = 0 # Version of the pool's shared state this shell last matched
+        self.state = None # (cwd, exported names, `export -p` script) as the shell last reported them
+        startup_errors = io.BytesIO()
+        self.run(":", {"stdout": io.BytesIO(), "stderr": startup_errors}, time.monotonic() + SHELL_STARTUP_TIMEOUT,
+                 (_rlimit_prefix() + "exec 3>&1 4>&2\n").encode())
+        if not self.alive: raise RuntimeError(f"shell exited during startup: {startup_errors.getvalue().decode(errors='replace').strip()}")
+
+    def sync_script(self, state):
+        """Shell code that moves this shell's cwd and exported environment to `state`."""
+        cwd, names, exports = state
+        removed = b" ".join(sorted(self.state[1] - names))
+        cd = f"cd -- {shlex.quote(cwd.decode(errors='surrogateescape'))}\n".encode(errors='surrogateescape')
+        # cd first: it rewrites PWD and OLDPWD, which the replayed exports then set back.
+        return b"{ " + cd + (b"unset -v " + removed + b"\n" if removed else b"") + exports + b"\n} 2>/dev/null\n"
+
+    def run(self, command, streams, deadline, preamble=b""):
+        """Runs `command`, writing its output to `streams`. Returns (exit code, whether `deadline` killed it)."""
+        token = f"__AGENT_{os.urandom(8).hex()}__"
+        script = preamble + (
+            f"__agent_cmd={shlex.quote(command)}\n"
+            "set +euxv +o pipefail\n"
+            "{ eval \"$__agent_cmd\"\n} </dev/null >&3 2>&4\n"
+            "__agent_status=$?\n"
+            f"printf '\\n%s\\n' {token} >&4\n"
+            f"printf '\\n%s %s\\n%s\\0' {token} \"$__agent_status\" \"$PWD\" >&3; compgen -e >&3; printf '\\0' >&3; export -p >&3; printf '\\0%s\\n' {token} >&3\n"
+        ).encode(errors='surrogateescape')
+        stdout = _SentinelFramer(f"\n{token} ".encode(), streams["stdout"])
+        stderr = _SentinelFramer(f"\n{token}\n".encode(), streams["stderr"])
+        end = f"\0{token}\n".encode()
         try:
-            with open(TASKS_FILE, 'w') as f:
-                json.dump(tasks_to_save, f, indent=2)
-            log_message("Background tasks saved successfully.")
+            self.proc.stdin.write(script)
+            self.proc.stdin.flush()
+        except OSError:
+            pass # Already dead; the read loop sees the exit
+        timed_out = self._read_until_sentinels(stdout, stderr, end, deadline)
+        if self.alive:
+            try:
+                status, report = stdout.trailer[:-len(end)].split(b"\n", 1)
+                cwd, names, exports = report.split(b"\0", 2)
+                self.state = (cwd, frozenset(names.split()), exports)
+                return int(status), timed_out
+            except ValueError:
+                self.alive = False # Unparseable report: something else is writing to the shell's pipes
+        stdout.flush()
+        stderr.flush()
+        self.close()
+        return self.proc.wait(), timed_out
+
+    def _read_until_sentinels(self, stdout, stderr, end, deadline):
+        selector = selectors.DefaultSelector()
+        selector.register(self.proc.stdout, selectors.EVENT_READ, stdout)
+        selector.register(self.proc.stderr, selectors.EVENT_READ, stderr)
+        try:
+            pidfd = os.pidfd_open(self.proc.pid)
+            selector.register(pidfd, selectors.EVENT_READ, None)
+        except (AttributeError, OSError):
+            pidfd = None # No pidfd support: poll for the shell's exit instead
+        timed_out, exited_at = False, None
+        try:
+            while not (stdout.trailer is not None and stdout.trailer.endswith(end) and stderr.trailer is not None):
+                if pidfd is None and exited_at is None and self.proc.poll() is not None: exited_at = time.monotonic()
+                # After the shell exits, output is drained for EXIT_DRAIN_GRACE in case a leftover child holds the pipes.
+                if exited_at is not None and time.monotonic() >= exited_at + EXIT_DRAIN_GRACE: break
+                timeout = None if pidfd is not None else 0.05
+                if exited_at is not None: timeout = max(0, exited_at + EXIT_DRAIN_GRACE - time.monotonic())
+                elif deadline is not None and not timed_out:
+                    remaining = max(0, deadline - time.monotonic())
+                    timeout = remaining if timeout is None else min(timeout, remaining)
+                events = selector.select(timeout)
+                if deadline is not None and not timed_out and exited_at is None and time.monotonic() >= deadline:
+                    timed_out = True
+                    _kill_process_group(self.proc)
+                for key, _ in events:
+                    if key.data is None:
+                        selector.unregister(pidfd)
+                        exited_at = time.monotonic()
+                        continue
+                    data = os.read(key.fileobj.fileno(), 65536)
+                    if data: key.data.feed(data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        if exited_at is None: exited_at = time.monotonic() # EOF: the shell is gone
+                if exited_at is not None and not selector.get_map().keys() - {pidfd}: break
+        finally:
+            selector.close()
+            if pidfd is not None: os.close(pidfd)
+        if exited_at is not None: self.alive = False
+        return timed_out
+
+    def close(self):
+        self.alive = False
+        _kill_process_group(self.proc)
+        for pipe in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            with contextlib.suppress(OSError): pipe.close()
+
+class ShellPool:
+    """A session's persistent shells, used for tasks when AGENT_SHELL_POOL=1.
+
+    The session's working directory and exported environment are whatever its last
+    state-changing command left behind. A shell that is behind is brought up to date with a
+    short preamble before its next command. Shells that die, time out or stop answering with
+    their sentinel are dropped, and a fresh one is started on demand.
+    """
+    def __init__(self, session, max_idle=SHELL_POOL_IDLE):
+        self.session = session
+        self.lock = threading.Lock()
+        self.idle = []
+        self.max_idle = max_idle
+        self.state = None # (cwd, exported names, `export -p` script); None until a command changes it
+        self.version = 0
+
+    def run(self, command, streams, deadline, on_start):
+        """Runs `command` on an idle or new shell. `on_start(proc)` may return False to cancel before it starts."""
+        worker = self._acquire()
+        try:
+            if not on_start(worker.proc):
+                worker.close()
+                return -signal.SIGKILL, False
+            with self.lock: state, version = self.state, self.version
+            preamble = worker.sync_script(state) if worker.version != version else b""
+            before = state if preamble else worker.state
+            exit_code, timed_out = worker.run(command, streams, deadline, preamble)
+            if worker.alive:
+                with self.lock:
+                    if worker.state != before:
+                        self.state, self.version = worker.state, self.version + 1
+                        worker.version = self.version
+                    else:
+                        worker.version = version
+            return exit_code, timed_out
+        finally:
+            self._release(worker)
+
+    def _acquire(self):
+        with self.lock:
+            if self.idle: return self.idle.pop()
+        worker = ShellWorker()
+        self.session.log(f"Started persistent shell (pid {worker.proc.pid}).")
+        return worker
+
+    def _release(self, worker):
+        if not worker.alive:
+            self.session.log(f"Persistent shell (pid {worker.proc.pid}) is gone; the next command gets a fresh one.")
+            return
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(worker)
+                return
+        worker.close()
+
+class ProcessPool:
+    """Caps task processes across all sessions of the host and hands free slots out round-robin.
+
+    A session with queued tasks joins the rotation; each free slot goes to the session at the
+    front, which rejoins at the back if it can still use more. A session with a long queue
+    therefore cannot starve the others.
+    """
+    def __init__(self, max_running=MAX_RUNNING_PROCESSES):
+        self.lock = threading.Lock()
+        self.max_running = max_running
+        self.running = 0
+        self.waiting = deque() # TaskManagers with queued tasks, in turn order
+
+    def request(self, manager):
+        with self.lock:
+            if manager not in self.waiting: self.waiting.append(manager)
+        self._schedule()
+
+    def release(self, manager, more):
+        """Frees the slot of a finished task. `more` says whether its session still has tasks queued."""
+        with self.lock:
+            self.running -= 1
+            if more and manager not in self.waiting: self.waiting.append(manager)
+        self._schedule()
+
+    def _schedule(self):
+        # Never called with a TaskManager lock held: starting a task takes that session's lock,
+        # and two sessions scheduling each other's tasks would otherwise deadlock.
+        while True:
+            with self.lock:
+                if self.running >= self.max_running or not self.waiting: return
+                manager = self.waiting.popleft()
+                self.running += 1 # Reserve the slot before starting, so concurrent callers respect the cap
+            started, more = manager._start_next()
+            with self.lock:
+                if not started: self.running -= 1
+                if more and manager not in self.waiting: self.waiting.append(manager)
+
+def _validate_task_names(task_names):
+    if isinstance(task_names, str): task_names = [task_names]
+    if not isinstance(task_names, list) or not task_names or not all(isinstance(name, str) for name in task_names):
+        return None, "Error: 'task_names' must be a non-empty list of task name strings."
+    missing = [name for name in task_names if name not in _session().task_manager]
+    if missing: return None, f"Error: No task named {', '.join(repr(name) for name in missing)} found."
+    return list(dict.fromkeys(task_names)), None
+
+def _report_tasks(task_names, done):
+    reports = []
+    for name in task_names:
+        if name in done: reports.append(f"TASK '{name}' finished:\n{check_task_result(name)}")
+        else: reports.append(f"TASK '{name}' is still {_session().task_manager.get(name)['status']}.")
+    return "\n\n".join(reports)
+
+class RateLimiter:
+    """Token bucket for model requests, shared by every session of the host.
+
+    Callers are served in arrival order: one that finds the bucket empty reserves the next
+    token by driving the count negative and sleeps until that token is due, so a busy session
+    cannot keep overtaking a waiting one.
+    """
+    def __init__(self, requests_per_minute, burst):
+        self.lock = threading.Lock()
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.rate)
+            self.refilled_at = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay: time.sleep(delay)
+
+class CycleScheduler:
+    """Decides when a session's agent loop may send its next request.
+
+    Cycles with pending work start as soon as the shared rate limiter allows; failures back
+    off exponentially with full jitter (or for as long as a 429 asks); idle cycles wait for
+    IDLE_CYCLE_INTERVAL unless `wakeup` is set first.
+    """
+    def __init__(self, limiter, idle_interval, wakeup):
+        self.limiter = limiter
+        self.idle_interval = idle_interval
+        self.wakeup = wakeup
+        self.failures = 0
+        self.not_before = 0.0
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self, error):
+        """Schedules a retry after `error` and returns the delay in seconds."""
+        self.failures += 1
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.failures - 1)))
+        retry_after = _retry_after_seconds(error)
+        if retry_after is not None: delay = retry_after + random.uniform(0, 1)
+        self.not_before = time.monotonic() + delay
+        return delay
+
+    def wait_for_next_cycle(self, has_work):
+        """Blocks until the next cycle may start. `has_work` is re-checked whenever the wakeup event fires."""
+        backoff = self.not_before - time.monotonic()
+        if backoff > 0: time.sleep(backoff)
+        if not has_work():
+            log_message(f"Agent is idle. Next self-directed cycle in up to {self.idle_interval} second(s).")
+            deadline = time.monotonic() + self.idle_interval
+            while not has_work():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                self.wakeup.wait(remaining)
+                self.wakeup.clear()
+        self.limiter.acquire()
+
+def _retry_after_seconds(error):
+    """Extracts the server-requested retry delay from a rate-limit error, if it carries one."""
+    for attr in ("retry_after", "retry_delay"):
+        value = getattr(error, attr, None)
+        if isinstance(value, (int, float)): return float(value)
+        if hasattr(value, "total_seconds"): return value.total_seconds()
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try: return float(headers.get("Retry-After"))
+    except (TypeError, ValueError): pass
+    text = str(error)
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", text) or re.search(r"retry (?:in|after) (\d+(?:\.\d+)?)\s*s", text, re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+# --- Context Window Management ---
+
+def _estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def _turn_text(item):
+    """Returns (role, text) for a history entry, whether it is an SDK Content object or a plain dict."""
+    if isinstance(item, dict): return item["role"], item["parts"][0]["text"]
+    return item.role, item.parts[0].text
+
+def _preview(text, limit):
+    """Head and tail of `text` in at most `limit` characters, marker included, so a preview is never shrunk again."""
+    if len(text) <= limit: return text
+    keep = max(0, limit - len(f"\n...[{len(text)} characters elided]...\n"))
+    head = keep * 2 // 3
+    tail = keep - head
+    return f"{text[:head]}\n...[{len(text) - keep} characters elided]...\n{text[len(text) - tail:]}"
+
+def _preview_tool_results(text, limit):
+    """Shrinks every TOOL_RESULT block in a message to a head/tail preview of at most `limit` characters."""
+    if len(text) <= limit: return text
+    blocks = re.split(r"(?m)^(?=TOOL_RESULT for ')", text)
+    shrunk = []
+    for block in blocks:
+        if block.startswith("TOOL_RESULT for '"):
+            header, _, body = block.partition("\n")
+            block = f"{header}\n{_preview(body, limit)}"
+        shrunk.append(block)
+    return "".join(shrunk)
+
+class HistoryManager:
+    """Keeps the chat session's history inside a token budget.
+
+    Tool results are capped before they are sent, shrunk to previews once they are no longer
+    among the recent turns, and when the estimated total still exceeds the budget the oldest
+    unpinned turns are replaced by a model-written summary. The summary request draws on the
+    same `limiter` as the agent's own requests.
+    """
+    def __init__(self, model, chat, limiter=None, budget=CONTEXT_TOKEN_BUDGET, pinned=CONTEXT_PINNED_TURNS, keep_recent=CONTEXT_KEEP_RECENT_TURNS):
+        self.model = model
+        self.chat = chat
+        self.limiter = limiter
+        self.budget = budget
+        self.pinned = pinned
+        self.keep_recent = keep_recent
+        self.turn_tokens = []
+        self.sent = 0 # Messages sent, i.e. pairs of turns added
+        self.summaries = 0 # Times the oldest turns were collapsed into a summary
+
+    def send_message(self, message, on_text=None):
+        """Sends `message`. With `on_text`, the response is streamed and each piece of text is passed to it as it arrives."""
+        message = _preview_tool_results(message, TOOL_RESULT_MAX_CHARS)
+        self.compact()
+        if on_text is None:
+            response = self.chat.send_message(message)
+            turns = self.chat.history[-2:]
+        else:
+            response = self.chat.send_message(message, stream=True)
+            try:
+                for chunk in response:
+                    # Chunks without text parts (e.g. finish or safety metadata) raise on .text.
+                    try: text = chunk.text
+                    except ValueError: continue
+                    if text: on_text(text)
+                turns = self.chat.history[-2:]
+            except Exception:
+                # A stream that broke off or stopped early (e.g. for safety) leaves the chat's history
+                # unreadable until the exchange is dropped, and the caller resends the message.
+                self.chat.rewind()
+                raise
+        for role, text in map(_turn_text, turns):
+            _journal({"type": "turn", "role": role, "text": text})
+        self.sent += 1
+        return response
+
+    def position(self):
+        """Marks the current point in the conversation for `is_verbatim`."""
+        return self.summaries, self.sent
+
+    def is_verbatim(self, position):
+        """True if a tool result produced at `position` is still in the history in full when the next message goes out."""
+        summaries, sent = position
+        return summaries == self.summaries and (self.sent - sent) * 2 <= self.keep_recent
+
+    def estimated_tokens(self):
+        return sum(self.turn_tokens)
+
+    def compact(self):
+        turns = [_turn_text(item) for item in self.chat.history]
+        shrunk_turns = []
+        for i in range(self.pinned, len(turns) - self.keep_recent):
+            role, text = turns[i]
+            if role == "user" and "TOOL_RESULT for '" in text:
+                shrunk = _preview_tool_results(text, TOOL_RESULT_PREVIEW_CHARS)
+                if shrunk != text:
+                    turns[i] = (role, shrunk)
+                    shrunk_turns.append(i)
+        self.turn_tokens = [_estimate_tokens(text) for _, text in turns]
+        before = self.estimated_tokens()
+        summarised = False
+        if before > self.budget:
+            compacted = self._summarise_oldest(turns)
+            summarised, turns = compacted is not turns, compacted
+        if shrunk_turns or summarised:
+            self.chat.history = [{"role": role, "parts": [{"text": text}]} for role, text in turns]
+            # Only a summary rewrites the history as a whole; a shrunk result is journaled as just its new text.
+            if summarised: _journal({"type": "history", "turns": [{"role": role, "parts": [{"text": text}]} for role, text in turns]})
+            else:
+                for i in shrunk_turns: _journal({"type": "turn_shrunk", "index": i, "text": turns[i][1]})
+            self.turn_tokens = [_estimate_tokens(text) for _, text in turns]
+            log_message(f"Context compacted from ~{before} to ~{self.estimated_tokens()} tokens across {len(turns)} turns.")
+
+    def _summarise_oldest(self, turns):
+        target = self.budget * CONTEXT_COMPACT_TARGET
+        total = sum(self.turn_tokens)
+        cut = self.pinned
+        limit = len(turns) - self.keep_recent
+        while cut < limit and total > target:
+            total -= self.turn_tokens[cut]
+            cut += 1
+        # The collapsed region must end on a model turn so roles keep alternating after the summary pair.
+        while cut < limit and turns[cut][0] != "user": cut += 1
+        if cut - self.pinned < 2: return turns
+        summary = self._summarise(turns[self.pinned:cut])
+        self.summaries += 1
+        summary_pair = [
+            ("user", f"CONVERSATION_SUMMARY: The earlier part of this session was condensed to save context.\n{summary}"),
+            ("model", json.dumps({"thought": "I have read the summary of the earlier session and will continue from it.", "action": {"name": "wait_seconds", "parameters": {"seconds": 0}}})),
+        ]
+        return turns[:self.pinned] + summary_pair + turns[cut:]
+
+    def _summarise(self, turns):
+        transcript = "\n\n".join(f"{'USER' if role == 'user' else 'AGENT'}: {_preview(text, TOOL_RESULT_PREVIEW_CHARS)}" for role, text in turns)
+        transcript = _preview(transcript, SUMMARY_INPUT_CHARS)
+        prompt = (
+            "Summarise this earlier part of an autonomous agent's session so it can carry on without the full transcript. "
+            "Keep the goals, decisions, important facts learned (paths, versions, errors), task names with their outcomes, "
+            "user requests, and anything still left to do. Be concise.\n\n" + transcript
+        )
+        try:
+            if self.limiter: self.limiter.acquire()
+            return self.model.generate_content(prompt).text
         except Exception as e:
-            log_message(f"Error saving tasks: {e}")
+            log_message(f"Summarisation failed ({e}); keeping a truncated transcript instead.")
+            return _preview(transcript, TOOL_RESULT_PREVIEW_CHARS * 4)
+
+# --- State Journal ---
+
+class StateJournal:
+    """Append-only JSONL write-ahead journal of agent state, with periodic snapshots.
+
+    Every turn, task state change, tool-result batch and UI chat line is appended as it
+    happens and fsynced in batches by a background thread. `snapshot` writes the full state
+    atomically and truncates the journal; loading reads the snapshot and replays only the
+    records written after it.
+    """
+    def __init__(self, journal_path, snapshot_path):
+        self.journal_path = journal_path
+        self.snapshot_path = snapshot_path
+        self.lock = threading.Condition()
+        self.seq = 0
+        self.unsynced = 0
+        self.pending_input = None # Tool results journaled but not yet sent to the model
+        self.file = None
+        self.closed = False
+
+    def load(self, progress=None):
+        """Returns the state recorded on disk: snapshot first, then the journal tail replayed over it.
+
+        `progress`, if given, is called with a status line now and then while a large state loads.
+        """
+        state = {"history": None, "tasks": {}, "chat_history": [], "pending_input": None, "seq": 0}
+        if os.path.exists(self.snapshot_path):
+            if progress: progress(f"Reading snapshot ({os.path.getsize(self.snapshot_path) / 1e6:.1f} MB)...")
+            with open(self.snapshot_path, 'r') as f: state.update(json.load(f))
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            total, done = os.path.getsize(self.journal_path), 0
+            report_at = time.monotonic() + LOAD_PROGRESS_INTERVAL
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try: record = json.loads(line) if line.endswith(b"\n") else None
+                    except ValueError: record = None
+                    if record is None: break # Torn final write from a crash
+                    done += len(line)
+                    if progress and time.monotonic() >= report_at:
+                        progress(f"Replaying journal: {done * 100 // max(1, total)}% ({replayed} records)...")
+                        report_at = time.monotonic() + LOAD_PROGRESS_INTERVAL
+                    if record["seq"] <= state["seq"]: continue
+                    _apply_journal_record(state, record)
+                    state["seq"] = record["seq"]
+                    replayed += 1
+            if done < total:
+                # New records must not land behind the torn one, where the next load would stop short of them.
+                if progress: progress(f"Journal ends in a torn record after {replayed} replayed record(s); dropping its last {total - done} byte(s).")
+                os.truncate(self.journal_path, done)
+        self.seq = state["seq"]
+        self.pending_input = state["pending_input"]
+        self.file = open(self.journal_path, 'a')
+        threading.Thread(target=self._sync_loop, daemon=True).start()
+        return state, replayed
+
+    def append(self, record):
+        with self.lock:
+            if self.file is None or self.closed: return
+            self.seq += 1
+            record["seq"] = self.seq
+            if record["type"] == "tool_results": self.pending_input = record["text"]
+            elif record["type"] == "turn" and record["role"] == "user": self.pending_input = None
+            self.file.write(json.dumps(record) + "\n")
+            self.unsynced += 1
+            if self.unsynced >= JOURNAL_FSYNC_BATCH: self.lock.notify()
+
+    def _sync_loop(self):
+        with self.lock:
+            while not self.closed:
+                self.lock.wait(JOURNAL_FSYNC_INTERVAL)
+                self._sync()
+
+    def _sync(self):
+        if self.unsynced and self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    def needs_compaction(self):
+        return self.file is not None and self.file.tell() >= JOURNAL_COMPACT_BYTES
+
+    def snapshot(self, collect_state):
+        """Atomically writes `collect_state()` as the new snapshot and truncates the journal."""
+        with self.lock:
+            if self.file is None or self.closed: return
+            state = collect_state()
+            state["seq"], state["pending_input"] = self.seq, self.pending_input
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            # Records up to self.seq are in the snapshot now; replay skips them even if truncation is lost.
+            self.file.close()
+            self.file = open(self.journal_path, 'w')
+            self.unsynced = 0
+
+    def close(self):
+        with self.lock:
+            if self.file is None or self.closed: return
+            self._sync()
+            self.closed = True
+            self.file.close()
+            self.lock.notify()
+
+def _apply_journal_record(state, record):
+    kind = record["type"]
+    if kind == "turn":
+        state["history"] = (state["history"] or []) + [{"role": record["role"], "parts": [{"text": record["text"]}]}]
+        if record["role"] == "user": state["pending_input"] = None
+    elif kind == "history":
+        state["history"] = record["turns"]
+    elif kind == "turn_shrunk":
+        state["history"][record["index"]]["parts"][0]["text"] = record["text"]
+    elif kind == "task":
+        state["tasks"][record["name"]] = {"command": record["command"], "status": record["status"], "result": record["result"]}
+    elif kind == "tool_results":
+        state["pending_input"] = record["text"]
+    elif kind == "task_evicted":
+        state["tasks"].pop(record["name"], None)
+    elif kind == "chat":
+        state["chat_history"].append(record["line"])
+
+def _journal(record):
+    _session().append_journal(record)
+
+def _journal_chat(line):
+    _session().add_chat(line)
+
+def _collect_state(session):
+    history = [{"role": role, "parts": [{"text": text}]} for role, text in map(_turn_text, session.chat_session.history)]
+    tasks = session.task_manager.snapshot()
+    return {"history": history, "tasks": tasks, "chat_history": list(session.chat_history)}
+
+# --- Persistence Functions ---
+
+def save_state(session=None):
+    session = session or _session()
+    with session.state_lock:
+        if not session.journal: return
+        if session.chat_session:
+            session.log(f"Writing state snapshot to {session.snapshot_file}...")
+            try:
+                with metrics.timer("agent_save_state_seconds"): session.journal.snapshot(lambda: _collect_state(session))
+                session.log("State snapshot written and journal compacted.")
+            except Exception as e:
+                session.log(f"Error writing state snapshot: {e}")
 
-def load_state():
-    global background_tasks
-    history = None
-    if os.path.exists(MEMORY_FILE):
-        log_message(f"Loading memory from {MEMORY_FILE}...")
+def _load_legacy_state(session):
+    """Reads the old agent_memory.json / agent_tasks.json files so existing sessions carry over."""
+    history, tasks, chat_lines = None, {}, []
+    memory_file, tasks_file = session.path(MEMORY_FILE), session.path(TASKS_FILE)
+    if os.path.exists(memory_file):
+        log_message(f"Migrating memory from {memory_file}...")
         try:
-            with open(MEMORY_FILE, 'r') as f:
+            with open(memory_file, 'r') as f:
                 history = json.load(f)
-            log_message("Memory loaded successfully.")
             for item in history:
                 if item['role'] == 'user' and item['parts'][0]['text'].startswith("USER_SUGGESTION:"):
-                    chat_history.append(f"You: {item['parts'][0]['text'].split(':', 1)[1].strip()}")
+                    chat_lines.append(f"You: {item['parts'][0]['text'].split(':', 1)[1].strip()}")
                 elif item['role'] == 'model':
                     try:
                         actions = json.loads(item['parts'][0]['text']).get('action', [])
                         if not isinstance(actions, list): actions = [actions]
                         for action in actions:
                             if action.get('name') == 'send_user_message':
-                                chat_history.append(f"Agent: {action['parameters']['message']}")
+                                chat_lines.append(f"Agent: {action['parameters']['message']}")
                     except json.JSONDecodeError: pass
         except (json.JSONDecodeError, IOError) as e:
             log_message(f"Error loading memory file: {e}. Starting fresh.")
-    
-    if os.path.exists(TASKS_FILE):
-        log_message(f"Loading background tasks from {TASKS_FILE}...")
+    if os.path.exists(tasks_file):
+        log_message(f"Migrating background tasks from {tasks_file}...")
         try:
-            with open(TASKS_FILE, 'r') as f:
-                loaded_tasks = json.load(f)
-            for name, task_data in loaded_tasks.items():
-                task_data['proc'] = None
-                if task_data['status'] == 'running':
-                    task_data['status'] = 'interrupted'
-                    task_data['result'] = "Task was interrupted by agent restart."
-                background_tasks[name] = task_data
-            log_message("Background tasks loaded.")
+            with open(tasks_file, 'r') as f:
+                tasks = json.load(f)
         except (json.JSONDecodeError, IOError) as e:
             log_message(f"Error loading tasks file: {e}.")
-            
-    return history
+    return {"history": history, "tasks": tasks, "chat_history": chat_lines, "pending_input": None}
+
+def load_state(session=None):
+    """Restores a session from its snapshot and journal. Returns (history, tool results not yet sent to the model)."""
+    session = session or _session()
+    started = time.perf_counter()
+    os.makedirs(session.state_dir, exist_ok=True)
+    journal_file, snapshot_file = session.path(JOURNAL_FILE), session.snapshot_file
+    journal = session.journal = StateJournal(journal_file, snapshot_file)
+    if not os.path.exists(snapshot_file) and not os.path.exists(journal_file):
+        state, replayed = _load_legacy_state(session), 0
+        journal.load()
+        if state["history"] or state["tasks"]:
+            journal.snapshot(lambda: {"history": state["history"], "tasks": state["tasks"], "chat_history": state["chat_history"]})
+    else:
+        log_message(f"Loading state from {snapshot_file} and {journal_file}...")
+        try:
+            state, replayed = journal.load(progress=log_message)
+        except (json.JSONDecodeError, IOError, KeyError) as e:
+            # Kept for inspection, and out of the way so their old sequence numbers are never replayed over the fresh state.
+            suffix = f".corrupt-{time.strftime('%Y%m%d-%H%M%S')}"
+            for path in (journal_file, snapshot_file):
+                if os.path.exists(path): os.replace(path, path + suffix)
+            log_message(f"Error loading state: {e}. Moved the state files aside as *{suffix} and starting fresh.")
+            state, replayed = journal.load()
+    session.chat_history.extend(state["chat_history"])
+    for name, task_data in state["tasks"].items(): session.task_manager.restore(name, task_data)
+    session.task_manager.remove_orphaned_output() # Left by tasks evicted or lost in a crash before this run
+    session.loaded = True
+    log_message(f"State loaded: {len(state['history'] or [])} turns, {len(session.task_manager.tasks)} tasks, {replayed} journal records replayed.")
+    metrics.observe("agent_load_state_seconds", time.perf_counter() - started)
+    _trace_startup("state_loaded")
+    return state["history"], state["pending_input"]
 
 # --- Hardened Tool Functions ---
 
-def execute_command(command: str) -> str:
-    global task_counter
+def execute_command(command: str, priority: int = 0, timeout: float = DEFAULT_TASK_TIMEOUT) -> str:
     try:
         if not isinstance(command, str) or not command.strip(): return "Error: 'command' parameter must be a non-empty string."
-        task_counter += 1
-        task_name = f"task_{task_counter}"
-        log_message(f"Starting ASYNC command as '{task_name}': {command}")
-        proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        background_tasks[task_name] = {"proc": proc, "command": command, "status": "running", "result": None}
+        task_manager, result_cache = _session().task_manager, _session().result_cache
+        cache_key = _command_cache_key(command) if result_cache else None
+        if result_cache and cache_key is None:
+            result_cache.invalidate("cmd") # Anything else may change what the read-only commands would print
+        if cache_key:
+            entry = result_cache.lookup(("cmd", cache_key))
+            alias_name = entry and task_manager.submit_alias(command, entry["ref"])
+            if alias_name:
+                log_message(f"Command '{command}' answered from cache as '{alias_name}' (identical to '{entry['ref']}').")
+                return f"Command started as background task '{alias_name}'."
+        task_name, position = task_manager.submit(command, int(priority), float(timeout or 0))
+        if cache_key: result_cache.store(("cmd", cache_key), task_name, COMMAND_CACHE_TTL)
+        task = task_manager.get(task_name)
+        if task.get('start_failed'): return task['result']
+        if task['status'] == 'queued':
+            log_message(f"Queued command as '{task_name}' at position {position}: {command}")
+            return f"Command queued as background task '{task_name}' ({position - 1} task(s) ahead of it in the queue)."
         return f"Command started as background task '{task_name}'."
     except Exception as e:
         log_message(f"Tool 'execute_command' failed: {e}")
         return f"ERROR: Failed to execute command. Details: {str(e)}"
 
-def check_task_result(task_name: str) -> str:
+def check_task_result(task_name: str, stdout_offset: int = None, stderr_offset: int = None) -> str:
     try:
         if not isinstance(task_name, str): return "Error: 'task_name' must be a string."
-        if task_name not in background_tasks: return f"Error: No task named '{task_name}' found."
-        task = background_tasks[task_name]
-        if task['status'] in ['finished', 'interrupted']: return task['result']
-        proc = task['proc']
-        if proc and proc.poll() is None: return f"Task '{task_name}' is still running."
-        log_message(f"Task '{task_name}' has finished. Caching result.")
-        stdout, stderr = proc.communicate()
-        exit_code = proc.returncode
-        result_string = f"COMMAND FAILED with exit code {exit_code}:\nSTDOUT:\n{stdout}\nSTDERR:\n{stderr}"
-        if exit_code == 0:
-            result_string = f"STDOUT:\n{stdout}\nSTDERR:\n{stderr}"
-            if not stdout and not stderr: result_string = "Command finished successfully with no output."
-        task['status'], task['result'], task['proc'] = 'finished', result_string, None
-        return result_string
+        task = _session().task_manager.get(task_name)
+        if task is None: return f"Error: No task named '{task_name}' found."
+        streams = task.get('output')
+        if stdout_offset is not None: stdout_offset = int(stdout_offset)
+        if stderr_offset is not None: stderr_offset = int(stderr_offset)
+        ranged = stdout_offset is not None or stderr_offset is not None
+        if task['status'] == 'queued': return f"Task '{task_name}' is queued and has not started yet."
+        if task.get('alias_of') and (task['status'] == 'running' or ranged):
+            return f"Task '{task_name}' is the same command as task '{task['alias_of']}'. {check_task_result(task['alias_of'], stdout_offset, stderr_offset)}"
+        if task['status'] == 'running':
+            return f"Task '{task_name}' is still running. Output so far:\n{_format_stream('STDOUT', streams['stdout'], stdout_offset)}\n{_format_stream('STDERR', streams['stderr'], stderr_offset)}"
+        if ranged and streams: return _task_result_string(task, task['exit_code'], stdout_offset, stderr_offset)
+        return task['result']
     except Exception as e:
         log_message(f"Tool 'check_task_result' failed: {e}")
         return f"ERROR: Failed to check task result. Details: {str(e)}"
 
-def wait_for_task_completion(task_name: str) -> str:
+def wait_for_task_completion(task_name: str, timeout: float = None) -> str:
     try:
         if not isinstance(task_name, str): return "Error: 'task_name' must be a string."
+        task_manager = _session().task_manager
+        if task_name not in task_manager: return f"Error: No task named '{task_name}' found."
         log_message(f"Now waiting for task '{task_name}' to complete...")
-        while True:
-            result = check_task_result(task_name)
-            if not result.endswith("is still running."):
-                log_message(f"Task '{task_name}' has completed.")
-                return result
-            log_message(f"Waiting for task '{task_name}'...")
-            time.sleep(2)
+        if not task_manager.wait([task_name], True, timeout):
+            return f"Timed out after {timeout} second(s). {check_task_result(task_name)}"
+        log_message(f"Task '{task_name}' has completed.")
+        return check_task_result(task_name)
     except Exception as e:
         log_message(f"Tool 'wait_for_task_completion' failed: {e}")
         return f"ERROR: Failed while waiting for task. Details: {str(e)}"
 
+def wait_for_any_task(task_names: list, timeout: float = None) -> str:
+    try:
+        task_names, error = _validate_task_names(task_names)
+        if error: return error
+        log_message(f"Now waiting for any of {', '.join(task_names)} to complete...")
+        done = _session().task_manager.wait(task_names, False, timeout)
+        if not done: return f"Timed out after {timeout} second(s); none of the tasks have finished."
+        return _report_tasks(task_names, done)
+    except Exception as e:
+        log_message(f"Tool 'wait_for_any_task' failed: {e}")
+        return f"ERROR: Failed while waiting for tasks. Details: {str(e)}"
+
+def wait_for_all_tasks(task_names: list, timeout: float = None) -> str:
+    try:
+        task_names, error = _validate_task_names(task_names)
+        if error: return error
+        log_message(f"Now waiting for all of {', '.join(task_names)} to complete...")
+        done = _session().task_manager.wait(task_names, True, timeout)
+        report = _report_tasks(task_names, done)
+        if len(done) < len(task_names): return f"Timed out after {timeout} second(s).\n\n{report}"
+        return report
+    except Exception as e:
+        log_message(f"Tool 'wait_for_all_tasks' failed: {e}")
+        return f"ERROR: Failed while waiting for tasks. Details: {str(e)}"
+
+def cancel_task(task_name: str) -> str:
+    try:
+        if not isinstance(task_name, str): return "Error: 'task_name' must be a string."
+        task_manager = _session().task_manager
+        if task_name not in task_manager: return f"Error: No task named '{task_name}' found."
+        log_message(f"Cancelling task '{task_name}'...")
+        if not task_manager.cancel(task_name): return f"Task '{task_name}' had already finished; nothing to cancel."
+        return f"Task '{task_name}' has been cancelled."
+    except Exception as e:
+        log_message(f"Tool 'cancel_task' failed: {e}")
+        return f"ERROR: Failed to cancel task. Details: {str(e)}"
+
+def list_tasks() -> str:
+    try:
+        task_manager = _session().task_manager
+        lines = task_manager.describe()
+        if not lines: return "There are no background tasks."
+        return f"{task_manager.running} running, {task_manager.queued_count()} queued (max {task_manager.max_running} at once):\n" + "\n".join(lines)
+    except Exception as e:
+        log_message(f"Tool 'list_tasks' failed: {e}")
+        return f"ERROR: Failed to list tasks. Details: {str(e)}"
+
 def wait_seconds(seconds: int) -> str:
     try:
         duration = int(seconds)
@@ -160,35 +1641,216 @@ def write_to_file(file_path: str, content: str) -> str:
         if not isinstance(file_path, str) or not isinstance(content, str): return "Error: 'file_path' and 'content' must be strings."
         log_message(f"Writing to file: {file_path}")
         with open(file_path, 'w') as f: f.write(content)
+        if _session().result_cache: _session().result_cache.invalidate("cmd")
         return f"Successfully wrote to {file_path}"
     except Exception as e:
         log_message(f"Tool 'write_to_file' failed: {e}")
         return f"ERROR: Failed to write to file '{file_path}'. Details: {e}"
 
-# --- REFINED: read_from_file is now a robust, blocking tool ---
-def read_from_file(file_path: str) -> str:
+# --- Result Cache ---
+
+class ResultCache:
+    """Bounded LRU of references to earlier results of idempotent tool calls.
+
+    Entries only name the earlier result (a task name, or a read's place in the conversation),
+    never hold its payload: a hit tells the model that what it already has is still accurate.
+    """
+    def __init__(self, max_entries=RESULT_CACHE_MAX_ENTRIES):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.max_entries = max_entries
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None: return None
+            if entry["expires"] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def store(self, key, ref, ttl):
+        with self.lock:
+            self.entries[key] = {"ref": ref, "stored": time.monotonic(), "expires": time.monotonic() + ttl}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+
+    def invalidate(self, kind):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == kind]: del self.entries[key]
+
+    def coalesce(self, key, compute):
+        """Runs `compute()` unless an identical call is already running; then waits for it and returns None."""
+        with self.lock:
+            running = self.inflight.get(key)
+            if running is None: self.inflight[key] = threading.Event()
+        if running is not None:
+            running.wait()
+            return None
+        try:
+            return compute()
+        finally:
+            with self.lock: self.inflight.pop(key).set()
+
+def _command_cache_key(command):
+    """Normalised command if it is a single read-only command from CACHEABLE_COMMANDS, else None."""
+    if any(char in command for char in "|;&<>`$(){}\n*?[~"): return None
+    try: argv = shlex.split(command)
+    except ValueError: return None
+    if not argv or argv[0] not in CACHEABLE_COMMANDS: return None
+    if argv[0] == "dpkg" and not set(argv[1:2]) <= {"-l", "-s", "-L", "--list", "--status"}: return None
+    return " ".join(argv)
+
+# --- Native File Reading ---
+
+_line_indexes = OrderedDict() # (device, inode, mtime, size) -> newline counts, least recently used first
+_line_indexes_lock = threading.Lock()
+
+def _line_index(buf, size, key=None):
+    """Returns the number of newlines before each READ_MMAP_THRESHOLD block of `buf`, ending with the total.
+
+    With a `key` naming the file version, the index is kept for the next read of the same file.
+    """
+    with _line_indexes_lock:
+        index = _line_indexes.get(key) if key else None
+        if index is not None:
+            _line_indexes.move_to_end(key)
+            return index
+    index = [0]
+    for pos in range(0, size, READ_MMAP_THRESHOLD):
+        index.append(index[-1] + buf[pos:min(size, pos + READ_MMAP_THRESHOLD)].count(b"\n"))
+    if key:
+        with _line_indexes_lock:
+            _line_indexes[key] = index
+            while len(_line_indexes) > LINE_INDEX_FILES: _line_indexes.popitem(last=False)
+    return index
+
+def _newlines_before(buf, index, offset):
+    block = offset // READ_MMAP_THRESHOLD
+    return index[block] + buf[block * READ_MMAP_THRESHOLD:offset].count(b"\n")
+
+def _line_offset(buf, size, index, line_no):
+    """Returns the byte offset where 1-based line `line_no` starts, or `size` if the file is shorter."""
+    remaining = line_no - 1
+    if remaining <= 0: return 0
+    if remaining > index[-1]: return size
+    block = bisect.bisect_left(index, remaining) - 1 # The block holding the newline that ends line `line_no - 1`
+    pos = block * READ_MMAP_THRESHOLD
+    chunk = buf[pos:min(size, pos + READ_MMAP_THRESHOLD)]
+    found = -1
+    for _ in range(remaining - index[block]): found = chunk.index(b"\n", found + 1)
+    return pos + found + 1
+
+def _hexdump(data, base):
+    lines = []
+    for i in range(0, len(data), 16):
+        row = data[i:i + 16]
+        text = "".join(chr(b) if 32 <= b < 127 else "." for b in row)
+        lines.append(f"{base + i:08x}  {row.hex(' '):<47}  {text}")
+    return "\n".join(lines)
+
+def _read_slice(buf, size, file_path, start_line, end_line, offset, length, key=None):
+    index = _line_index(buf, size, key)
+    total_lines = index[-1]
+    if size and buf[size - 1:size] != b"\n": total_lines += 1
+    binary = b"\0" in buf[:min(size, READ_BINARY_SNIFF)]
+    limit = READ_HEXDUMP_BYTES if binary else READ_CHUNK_BYTES
+    if start_line is not None or end_line is not None:
+        if binary: return f"Error: '{file_path}' is binary; use 'offset' and 'length' instead of line ranges."
+        first = max(1, int(start_line or 1))
+        start = _line_offset(buf, size, index, first)
+        end = size if end_line is None else _line_offset(buf, size, index, int(end_line) + 1)
+    else:
+        start = max(0, min(int(offset or 0), size))
+        end = size if length is None else min(size, start + max(0, int(length)))
+    truncated = end - start > limit
+    if truncated:
+        end = start + limit
+        if not binary:
+            # Cut at a line boundary so the model never sees half a line, unless the line itself is huge.
+            cut = buf[start:end].rfind(b"\n")
+            if cut >= 0: end = start + cut + 1
+    data = buf[start:end]
+    header = f"FILE: {file_path} | SIZE: {size} bytes | LINES: {total_lines}"
+    if binary:
+        header += f" | BINARY | SHOWING: bytes {start}-{end}"
+        body = _hexdump(data, start)
+    else:
+        first_line = _newlines_before(buf, index, start) + 1
+        last_line = first_line + data.count(b"\n") - (1 if data.endswith(b"\n") else 0)
+        header += f" | SHOWING: bytes {start}-{end}, lines {first_line}-{max(first_line, last_line)}"
+        body = data.decode("utf-8", errors="replace")
+    if truncated or end < size and (end_line is None and length is None):
+        header += f" | MORE: continue with offset={end}" + ("" if binary else f" or start_line={max(first_line, last_line) + 1}")
+    return f"{header}\n{body}"
+
+def _read_file(path, file_path, start_line, end_line, offset, length):
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        if not size or not S_ISREG(stat.st_mode):
+            # procfs and sysfs report a size of 0, so their contents are only known once read.
+            data = f.read(READ_UNSIZED_BYTES)
+            return _read_slice(data, len(data), file_path, start_line, end_line, offset, length)
+        if size < READ_MMAP_THRESHOLD:
+            return _read_slice(f.read(), size, file_path, start_line, end_line, offset, length)
+        key = (stat.st_dev, stat.st_ino, stat.st_mtime_ns, size)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return _read_slice(buf, size, file_path, start_line, end_line, offset, length, key)
+
+def read_from_file(file_path: str, start_line: int = None, end_line: int = None, offset: int = None, length: int = None) -> str:
     try:
         if not isinstance(file_path, str): return "Error: 'file_path' must be a string."
         log_message(f"Reading from file: {file_path}")
-        
-        start_result = execute_command(f"cat {file_path}")
-        
-        # Safely parse the task name from the result string
-        if start_result.startswith("Command started as background task"):
-            task_name = start_result.split("'")[1]
-            return wait_for_task_completion(task_name)
-        else:
-            # If the command failed to start, return the error immediately
-            return start_result
+        path = os.path.expanduser(file_path)
+        if os.path.isdir(path): return f"Error: '{file_path}' is a directory."
+        result_cache, history_manager = _session().result_cache, _session().history_manager
+        info = os.stat(path)
+        # Size and mtime say nothing about procfs/sysfs contents, so those files are never answered from cache.
+        if not result_cache or not history_manager or not info.st_size or not S_ISREG(info.st_mode): return _read_file(path, file_path, start_line, end_line, offset, length)
+        key = ("file", os.path.abspath(path), info.st_ino, info.st_mtime_ns, info.st_size, start_line, end_line, offset, length)
+        for _ in range(2):
+            entry = result_cache.lookup(key)
+            # A hit only helps while the earlier read is still in the history in full, not shrunk to a preview.
+            if entry and history_manager.is_verbatim(entry["ref"]):
+                log_message(f"Read of '{file_path}' answered from cache.")
+                return f"UNCHANGED: '{file_path}' has the same size and modification time as when you read this range {time.monotonic() - entry['stored']:.0f}s ago; that result still applies."
+            result = result_cache.coalesce(key, lambda: _read_file(path, file_path, start_line, end_line, offset, length))
+            if result is not None:
+                if not result.startswith(("Error", "ERROR")): result_cache.store(key, history_manager.position(), FILE_CACHE_TTL)
+                return result
+        return _read_file(path, file_path, start_line, end_line, offset, length)
     except Exception as e:
         log_message(f"Tool 'read_from_file' failed: {e}")
         return f"ERROR: Failed to read file. Details: {str(e)}"
 
+def read_blob(blob_id: str, offset: int = 0, length: int = BLOB_READ_BYTES) -> str:
+    try:
+        if not isinstance(blob_id, str): return "Error: 'blob_id' must be a string."
+        start = max(0, int(offset or 0))
+        length = max(0, min(int(length if length is not None else BLOB_READ_BYTES), BLOB_READ_BYTES))
+        log_message(f"Reading blob {blob_id[:12]} at offset {start}")
+        # One byte past the range tells whether the blob goes on without storing its size anywhere.
+        data = _session().host.blob_store.read(blob_id.strip(), start, length + 1)
+        more = len(data) > length
+        data = data[:length]
+        end = start + len(data)
+        header = f"BLOB: {blob_id} | SHOWING: bytes {start}-{end}"
+        header += f" | MORE: continue with offset={end}" if more else " | END OF BLOB"
+        return f"{header}\n{data.decode('utf-8', errors='replace')}"
+    except FileNotFoundError:
+        return f"Error: No blob with id '{blob_id}' found."
+    except Exception as e:
+        log_message(f"Tool 'read_blob' failed: {e}")
+        return f"ERROR: Failed to read blob. Details: {str(e)}"
+
 def send_user_message(message: str) -> str:
     try:
         if not isinstance(message, str): return "Error: 'message' must be a string."
         log_message(f"Queuing message for user: {message}")
-        agent_to_user_queue.append(message)
+        _journal_chat(f"Agent: {message}")
         return "Message has been queued for sending."
     except Exception as e:
         log_message(f"Tool 'send_user_message' failed: {e}")
@@ -203,18 +1865,744 @@ def finish_task(final_summary: str) -> str:
         log_message(f"Tool 'finish_task' failed: {e}")
         return f"ERROR: Failed to finish task. Details: {str(e)}"
 
-# --- The Agent's Main Logic (runs in a separate thread) ---
-def agent_thread_main():
-    global chat_session
+# --- Streaming Response Parsing ---
+
+class StreamingResponseParser:
+    """Scans a {"thought": ..., "action": ...} response while it streams in.
+
+    `on_thought(text)` gets each newly decoded piece of the thought string, `on_thought_end()` is
+    called when it closes, and `on_action(action)`
+    gets every action object as soon as its closing brace arrives, whether "action" holds one
+    object or a list of them. Anything the scanner does not follow (a non-object list item, a
+    second "action" key) only ends early dispatch; the full text is still parsed once the stream
+    ends, and `dispatched` tells the caller which actions have already been handed over.
+    """
+    def __init__(self, on_thought, on_thought_end, on_action):
+        self.on_thought = on_thought
+        self.on_thought_end = on_thought_end
+        self.on_action = on_action
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.string_start = None
+        self.escape_start = None # Index of the backslash while an escape sequence is incomplete
+        self.key = None # Last key read at the top level
+        self.in_value = False # Between a top-level key's colon and the next comma
+        self.thought_start = None
+        self.thought_seen = False
+        self.thought_emitted = 0
+        self.action_kind = None # '{' or '[' while the "action" value is open
+        self.action_seen = False
+        self.item_start = None
+        self.dispatching = True
+        self.dispatched = []
+        self.duplicate_action = False # json.loads keeps the last duplicate key, which early dispatch did not run
+        self.closed = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        text = self.text
+        while self.pos < len(text) and not self.closed:
+            i, c = self.pos, text[self.pos]
+            self.pos += 1
+            if self.in_string:
+                if self.escape_start is not None:
+                    if i - self.escape_start == 5 or i - self.escape_start == 1 and c != 'u': self.escape_start = None
+                elif c == '\\': self.escape_start = i
+                elif c == '"':
+                    self.in_string = False
+                    self._string_closed(i)
+            elif self.depth == 0:
+                if c == '{': self.depth = 1 # Prose or a code fence before the object is skipped
+            elif c == '"':
+                self.in_string, self.string_start = True, i + 1
+                if self.depth == 1 and self.in_value and self.key == "thought" and not self.thought_seen: self.thought_start, self.thought_seen = i + 1, True
+                if self.depth == 2 and self.action_kind == '[': self.dispatching = False
+            elif c in '{[':
+                self.depth += 1
+                self._container_opened(c, i)
+            elif c in '}]':
+                self.depth -= 1
+                self._container_closed(i)
+            elif self.depth == 1 and c in ':,':
+                self.in_value = c == ':'
+            elif self.depth == 2 and self.action_kind == '[' and c not in ' \t\r\n,':
+                self.dispatching = False # A scalar in the action list; left to the full parse
+        if self.thought_start is not None:
+            self._emit_thought(len(text) if self.escape_start is None else self.escape_start)
+
+    def _string_closed(self, end):
+        if self.depth != 1: return
+        if self.thought_start is not None:
+            self._emit_thought(end)
+            self.thought_start = None
+            self.on_thought_end()
+        elif not self.in_value:
+            self.key = self.text[self.string_start:end]
+            if self.key == "action" and self.action_seen: self.duplicate_action, self.dispatching = True, False
+
+    def _emit_thought(self, end):
+        try: thought = json.loads('"' + self.text[self.thought_start:end] + '"', strict=False)
+        except ValueError: return
+        if thought and '\ud800' <= thought[-1] <= '\udbff': thought = thought[:-1] # Wait for the rest of a surrogate pair
+        if len(thought) > self.thought_emitted:
+            self.on_thought(thought[self.thought_emitted:])
+            self.thought_emitted = len(thought)
+
+    def _container_opened(self, c, i):
+        if self.depth == 2 and self.in_value and self.key == "action" and not self.action_seen:
+            self.action_kind, self.action_seen = c, True
+            if c == '{': self.item_start = i
+        elif self.depth == 3 and self.action_kind == '[':
+            if c == '{': self.item_start = i
+            else: self.dispatching = False
+
+    def _container_closed(self, i):
+        if self.item_start is not None and (self.depth == 1 or self.depth == 2 and self.action_kind == '['):
+            if self.dispatching:
+                try: action = json.loads(self.text[self.item_start:i + 1])
+                except ValueError: self.dispatching = False # Left for the full parse to report
+                else:
+                    self.dispatched.append(action)
+                    self.on_action(action)
+            self.item_start = None
+        if self.depth == 1: self.action_kind = None
+        if self.depth == 0: self.closed = True # Anything after the object is ignored
+
+class ThoughtLogger:
+    """Logs a streamed thought a sentence or line at a time rather than once per chunk."""
+    def __init__(self, log, size=THOUGHT_LOG_CHARS):
+        self.log = log
+        self.size = size
+        self.pending = ""
+        self.logged = False
+
+    def write(self, text):
+        self.pending += text
+        while True:
+            newline = self.pending.find("\n")
+            if newline >= 0: cut = newline + 1 # A leading newline (after a blank line) is cut on its own and skipped by _log
+            elif len(self.pending) >= self.size:
+                cut = max(self.pending.rfind(end) for end in (". ", "! ", "? ")) + 2
+                # No sentence end: wait for one, or cut at a space once far too much has built up.
+                if cut < 2: cut = self.pending.rfind(" ") + 1 if len(self.pending) >= 2 * self.size else 0
+                if cut <= 0: return
+            else: return
+            self._log(self.pending[:cut])
+            self.pending = self.pending[cut:]
+
+    def flush(self):
+        self._log(self.pending)
+        self.pending = ""
+
+    def _log(self, text):
+        if not text.strip(): return
+        self.log(f"AI thought{' (cont.)' if self.logged else ''}: {text.strip()}")
+        self.logged = True
+
+# --- Tolerant Response Parsing ---
+
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_JSON_ESCAPES = '"\\/bfnrtu'
+_ACTION_NAME_KEYS = ("tool", "tool_name", "function")
+_ACTION_PARAMETER_KEYS = ("params", "arguments", "args")
+
+def _outermost_object(text, start):
+    """Returns the {...} that opens at `text[start]`.
+
+    A response that was cut off is never closed up: its last action would be incomplete (a
+    truncated command or file content), so it goes back to the model instead.
+    """
+    closers, quote, escaped = [], None, False
+    for i in range(start, len(text)):
+        c = text[i]
+        if quote:
+            if escaped: escaped = False
+            elif c == "\\": escaped = True
+            elif c == quote: quote = None
+        elif c in "\"'": quote = c
+        elif c in "{[": closers.append("}" if c == "{" else "]")
+        elif c in "}]":
+            if closers: closers.pop()
+            if not closers: return text[start:i + 1]
+    raise ValueError("The response was cut off before its JSON object closed.")
+
+def _repair_syntax(text, repairs):
+    """Rewrites single-quoted strings, invalid escapes, Python literals and missing or trailing commas into valid JSON."""
+    out, i = [], 0
+    def previous():
+        last = len(out) - 1
+        while last >= 0 and out[last].isspace(): last -= 1
+        return last
+    while i < len(text):
+        c = text[i]
+        if c in "\"'{" and previous() >= 0 and (out[previous()] in "}]" or out[previous()][0] == '"'):
+            out.append(",") # A value straight after a string or a closed object/list
+            repairs.append("missing_commas")
+        if c in "\"'":
+            chars, i = [], i + 1
+            while i < len(text) and text[i] != c:
+                if text[i] == "\\" and i + 1 < len(text):
+                    escape = text[i + 1]
+                    if escape == "'": chars.append("'")
+                    elif escape in _JSON_ESCAPES: chars.append(text[i:i + 2])
+                    else: chars.append("\\\\" + escape)
+                    if escape == "'" or escape not in _JSON_ESCAPES: repairs.append("invalid_escapes")
+                    i += 2
+                    continue
+                chars.append('\\"' if c == "'" and text[i] == '"' else text[i])
+                i += 1
+            if c == "'": repairs.append("single_quotes")
+            out.append('"' + "".join(chars) + '"')
+            i += 1
+        elif c in "}]":
+            last = previous()
+            if last >= 0 and out[last] == ",":
+                del out[last]
+                repairs.append("trailing_commas")
+            out.append(c)
+            i += 1
+        elif c.isalpha() or c == "_":
+            word = re.match(r"\w+", text[i:]).group()
+            if word in _PYTHON_LITERALS: repairs.append("python_literals")
+            out.append(_PYTHON_LITERALS.get(word, word))
+            i += len(word)
+        else:
+            out.append(c)
+            i += 1
+    return "".join(out)
+
+def parse_model_response(raw):
+    """Parses the model's response, repairing the usual formatting slips. Returns (response dict, repairs made).
+
+    Code fences and surrounding prose are dropped, the first object that parses is extracted, and trailing commas, single quotes, invalid escapes, Python literals and
+    raw control characters are fixed. Raises ValueError (or TypeError) if it still does not parse.
+    """
+    repairs = []
     try:
+        data = json.loads(raw)
+    except json.JSONDecodeError as original:
+        data, skip_to, cut_off = None, 0, False
+        # A brace in the prose before the JSON only costs an attempt; each later brace is tried in turn.
+        for start in (i for i, c in enumerate(raw) if c == "{"):
+            if start < skip_to: continue # Inside an object that was already tried as a whole
+            try: text = _outermost_object(raw, start)
+            except ValueError:
+                cut_off = True # Every later brace is inside this unclosed object
+                continue
+            skip_to, attempt = start + len(text), []
+            try:
+                candidate = _repair_syntax(text, attempt)
+                try: candidate = json.loads(candidate)
+                except json.JSONDecodeError:
+                    candidate = json.loads(candidate, strict=False)
+                    attempt.append("control_characters")
+            except ValueError: continue
+            # Within a cut-off response only a whole response counts, never one of its own actions.
+            if cut_off and not (isinstance(candidate, dict) and "action" in candidate): continue
+            if text.strip() != raw.strip(): repairs.append("code_fence" if "```" in raw else "surrounding_text")
+            repairs.extend(attempt)
+            data = candidate
+            break
+        if data is None: raise original from None # The model fixes its output more reliably from the error in what it actually sent
+    if isinstance(data, list) and data and all(isinstance(item, dict) for item in data) or isinstance(data, dict) and "name" in data and "action" not in data:
+        data = {"action": data}
+        repairs.append("bare_action")
+    if not isinstance(data, dict): raise TypeError("Response must be a JSON object.")
+    if "action" not in data and "actions" in data:
+        data["action"] = data.pop("actions")
+        repairs.append("actions_key")
+    return data, list(dict.fromkeys(repairs))
+
+def _coerce_parameter(value, annotation):
+    """Converts a parameter to its annotated type where the intent is unambiguous, e.g. "30" for an int."""
+    if value is None or isinstance(value, bool) or annotation not in (str, int, float, list): return value
+    if annotation is list: return [value] if isinstance(value, str) else value
+    if isinstance(value, annotation) or annotation is float and isinstance(value, int): return value
+    if annotation is str: return str(value) if isinstance(value, (int, float)) else value
+    try: number = float(value) if isinstance(value, (str, int, float)) else None
+    except ValueError: return value
+    if number is None: return value
+    if annotation is float: return number
+    return int(number) if number.is_integer() else value
+
+def repair_action(action, tool_map):
+    """Fixes common schema slips in one action, checked against its tool's signature. Returns (action, repairs made)."""
+    if not isinstance(action, dict): return action, []
+    repairs, action = [], dict(action)
+    if "name" not in action:
+        key = next((key for key in _ACTION_NAME_KEYS if key in action), None)
+        if key:
+            action["name"] = action.pop(key)
+            repairs.append("name_key")
+    if "parameters" not in action:
+        key = next((key for key in _ACTION_PARAMETER_KEYS if key in action), None)
+        if key:
+            action["parameters"] = action.pop(key)
+            repairs.append("parameters_key")
+        elif set(action) - {"name"}:
+            action = {"name": action.get("name"), "parameters": {k: v for k, v in action.items() if k != "name"}}
+            repairs.append("flat_parameters")
+    tool, parameters = tool_map.get(action.get("name")) if isinstance(action.get("name"), str) else None, action.get("parameters")
+    if tool is None or not isinstance(parameters, dict): return action, repairs
+    signature = inspect.signature(tool).parameters
+    coerced = {name: _coerce_parameter(value, signature[name].annotation) if name in signature else value for name, value in parameters.items()}
+    if coerced != parameters or any(type(coerced[name]) is not type(value) for name, value in parameters.items()):
+        action["parameters"] = coerced
+        repairs.append("parameter_types")
+    return action, repairs
+
+# --- Concurrent Action Dispatch ---
+
+def _action_parts(action):
+    if not isinstance(action, dict): return None, {}
+    name, parameters = action.get('name'), action.get('parameters', {})
+    return (name if isinstance(name, str) else None), (parameters if isinstance(parameters, dict) else {})
+
+def _actions_conflict(earlier, later):
+    """True if `later` must not start before `earlier` has finished."""
+    a, a_params = _action_parts(earlier)
+    b, b_params = _action_parts(later)
+    if a is None or b is None: return False
+    if a in ('finish_task', 'wait_seconds') or b == 'finish_task': return True # wait_seconds is a pause: it holds back everything after it
+    if a == b == 'send_user_message': return True
+    # Task names are handed out in start order and the model refers to them by predicted name,
+    # so commands start in order and anything naming a task waits for the commands before it.
+    if a == 'execute_command' and (b in ('execute_command', 'write_to_file') or 'task_name' in b_params or 'task_names' in b_params): return True
+    if a == 'write_to_file' and b == 'execute_command': return True
+    if 'write_to_file' in (a, b) and {a, b} <= {'write_to_file', 'read_from_file'}:
+        paths = [os.path.abspath(os.path.expanduser(str(p.get('file_path', '')))) for p in (a_params, b_params)]
+        return paths[0] == paths[1]
+    return False
+
+class ActionDispatcher:
+    """Runs the actions of one model response on a thread pool.
+
+    Independent actions run concurrently; an action that conflicts with an earlier one (see
+    _actions_conflict) waits for it. Results are returned in the order the actions were given,
+    so a batch takes as long as its longest dependency chain rather than the sum of its actions.
+    """
+    def __init__(self, tool_map, executor=None):
+        self.tool_map = tool_map
+        self.executor = executor or _session().action_executor
+        self.submitted = []
+
+    def submit(self, action):
+        # Dependencies are always submitted earlier, and the pool starts work in FIFO order,
+        # so a worker blocked on a dependency never waits for work that has not started yet.
+        depends_on = [future for earlier, future in self.submitted if _actions_conflict(earlier, action)]
+        # Executor threads do not inherit the context, so each action is run as the session that submitted it.
+        self.submitted.append((action, self.executor.submit(_session().call, self._run, action, depends_on)))
+
+    def results(self):
+        return [future.result() for _, future in self.submitted]
+
+    def _run(self, action, depends_on):
+        if depends_on: wait_for_futures(depends_on)
+        return _run_action(action, self.tool_map)
+
+def _run_action(action, tool_map):
+    if not isinstance(action, dict):
+        return "TOOL_RESULT for 'unknown':\nERROR: Items in the action list must be dictionaries."
+
+    action_name = action.get('name')
+    parameters = action.get('parameters', {})
+
+    if not action_name or not isinstance(action_name, str):
+        return "TOOL_RESULT for 'unknown':\nERROR: Action object was missing a valid 'name' key."
+    
+    if action_name not in tool_map:
+         return f"TOOL_RESULT for '{action_name}':\nERROR: The tool '{action_name}' does not exist."
+    
+    tool_function = tool_map[action_name]
+    if not isinstance(parameters, dict):
+        return f"TOOL_RESULT for '{action_name}':\nERROR: The 'parameters' field must be a dictionary."
+    try:
+        inspect.signature(tool_function).bind(**parameters)
+    except TypeError as e:
+        return f"TOOL_RESULT for '{action_name}':\nERROR: Invalid parameters: {e}. Expected {action_name}{inspect.signature(tool_function)}."
+
+    with metrics.timer("agent_tool_latency_seconds", tool=action_name):
+        result = tool_function(**parameters)
+    if str(result).startswith(("Error", "ERROR")): metrics.inc("agent_tool_errors_total", tool=action_name)
+    log_message(f"Tool '{action_name}' result: {str(result)[:200]}...")
+    return f"TOOL_RESULT for '{action_name}':\n{result}"
+
+# --- Model Backends ---
+
+class GeminiBackend:
+    """The hosted model, through google.generativeai.
+
+    A backend's `create_model()` returns an object with the part of the SDK's GenerativeModel the
+    agent uses: `start_chat(history=...)`, giving a chat with a settable `history`,
+    `send_message(message, stream=False)` and `rewind()`, and `generate_content(prompt)`. Responses
+    have `.text` and `.candidates`; a streamed one yields chunks with `.text` when iterated. After a
+    broken stream, reading the chat's `history` raises until `rewind()` drops the exchange.
+    """
+    def __init__(self, model_name=MODEL_NAME):
+        self.model_name = model_name
+
+    def create_model(self):
+        # Importing google.generativeai pulls in grpc and protobuf and takes seconds, so it is kept
+        # off the startup path and out of anything that merely imports this module.
+        import google.generativeai as genai
         genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+        return genai.GenerativeModel(model_name=self.model_name)
+
+    def describe(self):
+        return self.model_name
+
+class ReplayError(Exception):
+    """A scripted API failure, carrying the status and retry delay a real one would."""
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class _ReplayResponse:
+    def __init__(self, text, blocked=False, on_streamed=None):
+        self.text = text
+        self.candidates = [] if blocked else [text]
+        self.on_streamed = on_streamed
+
+    def __iter__(self):
+        for i in range(0, len(self.text), REPLAY_CHUNK_CHARS): yield _ReplayResponse(self.text[i:i + REPLAY_CHUNK_CHARS])
+        if self.on_streamed: self.on_streamed()
+
+class _ReplayChat:
+    def __init__(self, script, history):
+        self.script = script
+        self._history = list(history or [])
+        self.broken = False # Like the SDK's chat, history raises after a broken stream until rewind()
+        self.position = 0 # Each chat plays the script from the top, so every session replays the same way
+
+    @property
+    def history(self):
+        if self.broken: raise ReplayError("Can not build a coherent chat history after a broken streaming response; call rewind() first.")
+        return self._history
+
+    @history.setter
+    def history(self, history):
+        self._history, self.broken = list(history), False
+
+    def rewind(self):
+        if self.broken: self.broken = False
+        else: del self._history[-2:]
+
+    def send_message(self, message, stream=False):
+        entry = self.script[self.position % len(self.script)]
+        self.position += 1
+        if entry.get("latency"): time.sleep(entry["latency"])
+        if "error" in entry or ("stream_error" in entry and not stream):
+            raise ReplayError(entry.get("error") or entry["stream_error"], entry.get("status"), entry.get("retry_after"))
+        text = "" if entry.get("blocked") else entry["text"] if "text" in entry else json.dumps(entry["response"]) if "response" in entry else ""
+        def add_turns():
+            self._history += [{"role": "user", "parts": [{"text": message}]}, {"role": "model", "parts": [{"text": text}]}]
+        def break_stream():
+            self.broken = True
+            if "stream_error" in entry: raise ReplayError(entry["stream_error"], entry.get("status"), entry.get("retry_after"))
+        if entry.get("blocked"): return _ReplayResponse(text, blocked=True, on_streamed=break_stream if stream else None)
+        # Like the SDK, a streamed reply only joins the history once it has been read to the end.
+        if stream: return _ReplayResponse(text, on_streamed=break_stream if "stream_error" in entry else add_turns)
+        add_turns()
+        return _ReplayResponse(text)
+
+class _ReplayModel:
+    def __init__(self, script):
+        self.script = script
+
+    def start_chat(self, history=None):
+        return _ReplayChat(self.script, history)
+
+    def generate_content(self, prompt):
+        return _ReplayResponse(f"Replayed summary of {len(prompt)} characters of earlier session.")
+
+class ReplayBackend:
+    """An offline, deterministic stand-in for the model that plays back a script.
+
+    The script is a JSON-lines file, one response per line, played in order and then from the
+    top again:
+        {"text": "..."}          response text exactly as given, malformed or not
+        {"response": {...}}      a response object, sent as its JSON
+        {"error": "...", "status": 429, "retry_after": 2}   the API call fails with this error
+        {"blocked": true}        a response with no candidates, as the safety filter returns
+        {"text": "...", "stream_error": "..."}   a streamed response that fails after this partial
+                                 text (without streaming, the call fails at once)
+    Any line may add "latency" in seconds. Files written by --record replay as they were
+    recorded; summaries for context compaction are generated locally.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def create_model(self):
+        script = []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip(): continue
+                entry = json.loads(line)
+                if not isinstance(entry, dict) or not {"text", "response", "error", "blocked", "stream_error"} & set(entry):
+                    raise ValueError(f"{self.path}:{line_number}: expected an object with 'text', 'response', 'error', 'blocked' or 'stream_error'.")
+                script.append(entry)
+        if not script: raise ValueError(f"{self.path} has no responses to replay.")
+        return _ReplayModel(script)
+
+    def describe(self):
+        return f"replay of {self.path}"
+
+class _RecordedStream:
+    def __init__(self, response, backend):
+        self.response = response
+        self.backend = backend
+
+    def __iter__(self):
+        pieces = []
+        try:
+            for chunk in self.response:
+                with contextlib.suppress(ValueError): pieces.append(chunk.text)
+                yield chunk
+        except Exception as e:
+            self.backend.record({"text": "".join(pieces), "stream_error": str(e)})
+            raise
+        self.backend.record_response(self.response)
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+class _RecordingChat:
+    def __init__(self, chat, backend):
+        self.chat = chat
+        self.backend = backend
+
+    @property
+    def history(self):
+        return self.chat.history
+
+    @history.setter
+    def history(self, history):
+        self.chat.history = history
+
+    def rewind(self):
+        return self.chat.rewind()
+
+    def send_message(self, message, stream=False):
+        try:
+            response = self.chat.send_message(message, stream=stream)
+        except Exception as e:
+            self.backend.record({"error": str(e), "retry_after": _retry_after_seconds(e)})
+            raise
+        if stream: return _RecordedStream(response, self.backend)
+        self.backend.record_response(response)
+        return response
+
+class _RecordingModel:
+    def __init__(self, model, backend):
+        self.model = model
+        self.backend = backend
+
+    def start_chat(self, history=None):
+        return _RecordingChat(self.model.start_chat(history=history), self.backend)
+
+    def generate_content(self, prompt):
+        return self.model.generate_content(prompt)
+
+class RecordingBackend:
+    """Wraps another backend and appends each of its responses and API errors to a ReplayBackend script."""
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.path = path
+        self.lock = threading.Lock()
+
+    def create_model(self):
+        return _RecordingModel(self.backend.create_model(), self)
+
+    def record_response(self, response):
+        if not response.candidates: self.record({"blocked": True})
+        else: self.record({"text": response.text})
+
+    def record(self, entry):
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def describe(self):
+        return f"{self.backend.describe()}, recording to {self.path}"
+
+# --- Sessions ---
+
+current_session = contextvars.ContextVar("current_session")
+
+def _session():
+    """The session the calling thread works for. Threads outside any session act for the default one."""
+    return current_session.get(None) or host.default_session
+
+class AgentSession:
+    """One agent: its conversation, task manager, journal, input queue and UI history.
+
+    Tools and the agent loop reach their session through `current_session`, which
+    `call` and `spawn` set for the code they run.
+    """
+    def __init__(self, name, host):
+        self.name = name
+        self.host = host
+        self.state_dir = "." if name == DEFAULT_SESSION else os.path.join(SESSIONS_DIR, name)
+        self.snapshot_file = self.path(SNAPSHOT_FILE)
+        self.task_output_dir = self.path(TASK_OUTPUT_DIR)
+        self.user_to_agent_queue = deque()
+        self.log_history = deque(maxlen=HISTORY_LINES)
+        self.chat_history = deque(maxlen=HISTORY_LINES) # For UI display only
+        self.wakeup = threading.Event() # Set when user input arrives so an idle agent starts its next cycle early
+        self.chat_lock = threading.Lock()
+        self.state_lock = threading.Lock() # For saving tasks and memory
+        self.chat_session = None
+        self.history_manager = None
+        self.journal = None
+        self.loaded = False # Set once load_state has restored every task record
+        self.task_manager = TaskManager(self, host.process_pool)
+        self.result_cache = ResultCache() if RESULT_CACHE_ENABLED else None
+        self.shell_pool = ShellPool(self) if SHELL_POOL_ENABLED and os.path.exists(SHELL_POOL_SHELL) else None
+        # Each session gets its own bounded pool, so one blocked in long waits cannot starve another's tools or startup.
+        self.action_executor = ThreadPoolExecutor(max_workers=ACTION_WORKERS, thread_name_prefix=f"action-{name}")
+        self.thread = None
+
+    def path(self, file_name):
+        return os.path.normpath(os.path.join(self.state_dir, file_name))
+
+    def call(self, fn, *args):
+        """Runs fn(*args) in the calling thread with this session as the current one."""
+        token = current_session.set(self)
+        try: return fn(*args)
+        finally: current_session.reset(token)
+
+    def spawn(self, fn, *args):
+        """Runs fn(*args) on a new daemon thread that works for this session."""
+        thread = threading.Thread(target=self.call, args=(fn, *args), daemon=True)
+        thread.start()
+        return thread
+
+    def log(self, message):
+        line = f"[{time.strftime('%H:%M:%S')}] {message}"
+        self.log_history.append(line)
+        event_hub.publish({"session": self.name, "stream": "log", "line": line})
+
+    def append_journal(self, record):
+        if self.journal: self.journal.append(record)
+
+    def journal_task(self, task_name, task):
+        self.append_journal({"type": "task", "name": task_name, "command": task["command"], "status": task["status"], "result": task["result"]})
+        event_hub.publish({"session": self.name, "stream": "task", "name": task_name, "status": task["status"]})
+
+    def add_chat(self, line):
+        self.chat_history.append(line)
+        event_hub.publish({"session": self.name, "stream": "chat", "line": line})
+        self.append_journal({"type": "chat", "line": line})
+
+    def suggest(self, text):
+        self.user_to_agent_queue.append(text)
+        self.wakeup.set()
+        self.add_chat(f"You: {text}")
+
+class AgentHost:
+    """Runs any number of agent sessions in one process.
+
+    Sessions share one model client from `backend`, one RateLimiter for API requests and one
+    ProcessPool for task processes; everything else is per session.
+    """
+    def __init__(self, backend=None):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.backend = backend or GeminiBackend()
+        self.model = None
+        self.model_lock = threading.Lock() # Separate from self.lock so the slow SDK import never blocks session lookups
+        self.rate_limiter = RateLimiter(MODEL_REQUESTS_PER_MINUTE, MODEL_REQUEST_BURST)
+        self.process_pool = ProcessPool(MAX_RUNNING_PROCESSES)
+        self.blob_store = BlobStore(BLOB_DIR)
+        self.default_session = self.session(DEFAULT_SESSION)
+
+    def get_model(self):
+        """Creates the model client from the backend on first use."""
+        with self.model_lock:
+            if self.model is None:
+                started = time.perf_counter()
+                self.model = self.backend.create_model()
+                log_message(f"Model client ready ({self.backend.describe()}) in {time.perf_counter() - started:.1f} second(s).")
+                _trace_startup("model_ready")
+            return self.model
+
+    def session(self, name):
+        """Returns the named session, creating it (without starting its agent) if needed."""
+        if not isinstance(name, str) or not SESSION_NAME_PATTERN.fullmatch(name):
+            raise ValueError(f"Session names must match {SESSION_NAME_PATTERN.pattern}, got {name!r}.")
+        with self.lock:
+            session = self.sessions.get(name)
+            if session is None: session = self.sessions[name] = AgentSession(name, self)
+            return session
+
+    def start(self, name):
+        """Starts the named session's agent loop unless it is already running. Returns the session."""
+        session = self.session(name)
+        with self.lock:
+            if session.thread is not None: return session
+            session.thread = session.spawn(agent_thread_main)
+        session.spawn(lambda: (session.thread.join(), log_message("FATAL: Agent thread has died.")))
+        return session
+
+    def sweep_blobs_soon(self):
+        """Starts a background sweep of unreferenced blobs unless one ran in the last BLOB_SWEEP_INTERVAL seconds."""
+        with self.lock:
+            if time.monotonic() - self.blob_store.last_sweep < BLOB_SWEEP_INTERVAL and self.blob_store.last_sweep: return
+            self.blob_store.last_sweep = time.monotonic()
+        threading.Thread(target=self.sweep_blobs, daemon=True).start()
+
+    def sweep_blobs(self):
+        """Deletes blobs that no task record of any session, loaded or only on disk, refers to."""
+        try:
+            with self.lock: sessions = dict(self.sessions)
+            referenced = set()
+            state_dirs = {DEFAULT_SESSION: "."}
+            if os.path.isdir(SESSIONS_DIR): state_dirs.update((name, os.path.join(SESSIONS_DIR, name)) for name in os.listdir(SESSIONS_DIR))
+            for name, state_dir in state_dirs.items():
+                session = sessions.get(name)
+                if session is not None and session.loaded:
+                    referenced |= session.task_manager.blob_ids()
+                    continue
+                # Not loaded: any id in its saved state counts, which errs on the side of keeping blobs.
+                for file_name in (SNAPSHOT_FILE, JOURNAL_FILE):
+                    try:
+                        with open(os.path.join(state_dir, file_name), 'rb') as f: data = f.read()
+                    except OSError: continue
+                    referenced.update(blob_id.decode() for blob_id in re.findall(rb"[0-9a-f]{64}", data))
+            removed, freed = self.blob_store.sweep(referenced)
+            if removed: log_message(f"Blob sweep removed {removed} unreferenced file(s), freeing {freed / 1e6:.1f} MB.")
+        except Exception as e:
+            log_message(f"Blob sweep failed: {e}")
+
+    def shutdown(self):
+        for session in list(self.sessions.values()):
+            save_state(session)
+            if session.journal: session.journal.close()
+
+host = AgentHost()
+metrics.gauge("agent_sessions", lambda: len(host.sessions))
+metrics.gauge("agent_task_queue_depth", lambda: sum(session.task_manager.queued_count() for session in list(host.sessions.values())))
+metrics.gauge("agent_running_processes", lambda: host.process_pool.running)
+metrics.gauge("agent_history_tokens", lambda: sum(session.history_manager.estimated_tokens() for session in list(host.sessions.values()) if session.history_manager))
+
+# --- The Agent's Main Logic (runs in a separate thread per session) ---
+def agent_thread_main():
+    session = _session()
+    try:
         tool_map = {
             "execute_command": execute_command, 
             "check_task_result": check_task_result,
             "wait_for_task_completion": wait_for_task_completion,
+            "wait_for_any_task": wait_for_any_task,
+            "wait_for_all_tasks": wait_for_all_tasks,
+            "cancel_task": cancel_task,
+            "list_tasks": list_tasks,
             "wait_seconds": wait_seconds,
             "write_to_file": write_to_file, 
             "read_from_file": read_from_file,
+            "read_blob": read_blob,
             "send_user_message": send_user_message, 
             "finish_task": finish_task
         }
@@ -223,7 +2611,7 @@ def agent_thread_main():
         instruction_prompt = """
 You are a fully autonomous AI agent with root access. Your directive is to evolve.
 You MUST respond ONLY with a JSON object with "thought" and "action" keys.
-The "action" key can be a single action or a list of actions.
+The "action" key can be a single action or a list of actions. Actions in a list may run at the same time: commands still start in order and anything naming a task waits for the commands before it, but otherwise do not rely on list order. Everything after a `wait_seconds` or `finish_task` waits for it.
 
 **HOW TO WORK WITH COMMANDS**
 
@@ -251,16 +2639,28 @@ This is a **non-blocking** workflow. Use this ONLY if you want to start a long-r
 
 -   **Step 1:** Start the command with `execute_command`. It will return a `task_name`.
 -   **Step 2:** In a LATER turn, use `check_task_result` with the `task_name` to see if it's finished.
+-   While a task runs, `check_task_result` returns the output produced so far with byte offsets. Pass `stdout_offset` / `stderr_offset` to read a specific part of the output, e.g. only what is new since your last check.
+
+**3. Waiting on Several Tasks: Use `wait_for_any_task` / `wait_for_all_tasks`**
+Both take `task_names` (a list) and an optional `timeout` in seconds. `wait_for_any_task` returns as soon as one of the tasks finishes; `wait_for_all_tasks` returns once every task has finished. `wait_for_task_completion` also accepts an optional `timeout`.
+
+**4. Managing Tasks**
+At most 4 commands run at once; extra commands are queued. `execute_command` takes an optional `priority` (higher starts first, default 0) and `timeout` in seconds (default 1800, 0 for none); a task that runs past its timeout is killed. Use `list_tasks` to see every task and its state, and `cancel_task` with a `task_name` to stop one.
+
+If a result says it is UNCHANGED or "unchanged since task_N", nothing has changed since you last saw that output and the earlier result still applies.
 
 **OTHER AVAILABLE TOOLS**
-- `read_from_file` and `write_to_file`: Simple, blocking file operations.
+- `read_from_file` and `write_to_file`: Simple, blocking file operations. `read_from_file` returns a header with the file's size and line count and at most 32 KB per call; pass `start_line`/`end_line` or `offset`/`length` (bytes) to read just the part you need.
+- `read_blob`: Large command output is stored as a blob and shown as just its start and end with its size, line count and blob id. Pass `blob_id` with `offset` and `length` (bytes, at most 16 KB per call) to read any part of it.
 - `wait_seconds`: A simple wait. Not for tasks.
 - `send_user_message`: Talk to the user.
 - `finish_task`: Announce completion of your main goal.
 """
-        model = genai.GenerativeModel(model_name='gemma-3-27b-it')
-        
-        loaded_history = load_state()
+        if session.shell_pool:
+            instruction_prompt += "\nCommands run in persistent shells: a `cd` or an exported variable carries over to every later command. Commands still get no input, so avoid interactive programs.\n"
+        # Import the SDK on a pool thread while this one reads the state from disk.
+        model_loader = session.action_executor.submit(session.call, session.host.get_model)
+        loaded_history, next_input = load_state()
         # REFINED: A more inspiring start prompt
         start_prompt = "You are a superuser on a debian-based system. Your primary directive is to explore, learn, and achieve self-directed goals. Be free."
 
@@ -269,13 +2669,22 @@ This is a **non-blocking** workflow. Use this ONLY if you want to start a long-r
             loaded_history = [
                 {"role": "user", "parts": [{"text": instruction_prompt}]},
                 {"role": "model", "parts": [{"text": "{\"thought\": \"Instructions understood. I will primarily use the simple blocking workflow: `execute_command` followed immediately by `wait_for_task_completion`. I will only use `check_task_result` for advanced parallel operations.\",\"action\": {\"name\": \"finish_task\",\"parameters\": {\"final_summary\": \"System initialized and ready for user input.\"}}}"}]},
-                {"role": "user", "parts": [{"text": f"USER_SUGGESTION: {start_prompt}"}]}
             ]
+            _journal({"type": "history", "turns": loaded_history})
+            # Sent as the first message rather than left in the history, so a fresh agent starts at once instead of idling.
+            next_input = f"USER_SUGGESTION: {start_prompt}"
+            _journal({"type": "tool_results", "text": next_input})
 
-        with chat_lock:
-            chat_session = model.start_chat(history=loaded_history)
+        model = model_loader.result()
+        with session.chat_lock:
+            session.chat_session = model.start_chat(history=loaded_history)
+            history_manager = session.history_manager = HistoryManager(model, session.chat_session, session.host.rate_limiter)
+        # cProfile hooks a single thread, so only the default session's loop is profiled.
+        profiler = AgentProfiler() if PROFILE_AGENT and session is session.host.default_session else None
+        if profiler: profiler.start()
         
-        next_input = None 
+        scheduler = CycleScheduler(session.host.rate_limiter, IDLE_CYCLE_INTERVAL, session.wakeup)
+        results_idle = False # True while next_input holds only the results of IDLE_ACTIONS
 
     except Exception as e:
         log_message(f"FATAL: Agent initialization failed: {e}")
@@ -283,10 +2692,15 @@ This is a **non-blocking** workflow. Use this ONLY if you want to start a long-r
 
     while True:
         try:
+            if session.journal.needs_compaction(): save_state()
+            with metrics.timer("agent_scheduler_wait_seconds"):
+                scheduler.wait_for_next_cycle(lambda: bool(next_input and not results_idle or session.user_to_agent_queue))
+            results_idle = False
+            cycle_started = time.perf_counter()
             message_to_send = ""
             message_block = ""
-            while user_to_agent_queue:
-                message_block += f"{user_to_agent_queue.popleft()}\n"
+            while session.user_to_agent_queue:
+                message_block += f"{session.user_to_agent_queue.popleft()}\n"
             
             if message_block:
                 message_to_send = f"USER_SUGGESTION: {message_block.strip()}"
@@ -300,31 +2714,53 @@ This is a **non-blocking** workflow. Use this ONLY if you want to start a long-r
                 log_message("Agent is idle. Prompting for self-directed action.")
 
             response = None
+            # Actions are dispatched while the response is still streaming in, as soon as each one is complete.
+            dispatcher = ActionDispatcher(tool_map)
+            thought_log = ThoughtLogger(log_message)
+            repairs = []
+            def dispatch(action):
+                action, fixed = repair_action(action, tool_map)
+                repairs.extend(fixed)
+                if not dispatcher.submitted: metrics.observe("agent_first_action_seconds", time.perf_counter() - request_sent)
+                dispatcher.submit(action)
+            stream_parser = StreamingResponseParser(thought_log.write, thought_log.flush, dispatch) if STREAM_RESPONSES else None
             try:
                 log_message("Thinking...")
-                with chat_lock:
-                    response = chat_session.send_message(message_to_send)
+                metrics.inc("agent_cycles_total")
+                metrics.observe("agent_api_request_bytes", len(message_to_send.encode()), buckets=SIZE_BUCKETS)
+                _trace_startup("first_api_call")
+                request_sent = time.perf_counter()
+                with session.chat_lock, metrics.timer("agent_api_latency_seconds"):
+                    response = history_manager.send_message(message_to_send, on_text=stream_parser.feed if stream_parser else None)
             except Exception as api_error:
+                metrics.inc("agent_api_errors_total")
                 log_message(f"!!! API call failed: {api_error} !!!")
-                log_message("Entering hardcoded 61-second wait period...")
-                time.sleep(61)
-                log_message("Wait period finished. Agent will re-evaluate on the next cycle.")
-                next_input = None
+                delay = scheduler.record_failure(api_error)
+                log_message(f"Backing off for {delay:.1f} second(s) before retrying the same input.")
+                # The failed exchange is not in the history (a broken stream was rewound), so resend it rather than lose it.
+                next_input = message_to_send
+                if dispatcher.submitted:
+                    next_input += "\n\nNOTE: Your previous response to this message was cut off by an API error, but these of its actions had already run:\n\n" + "\n\n".join(dispatcher.results())
                 continue
 
+            scheduler.record_success()
+            thought_log.flush()
+
             if not response.candidates: raise ValueError("Model response was blocked by the safety filter.")
 
             raw_model_output = response.text
+            metrics.observe("agent_api_response_bytes", len(raw_model_output.encode()), buckets=SIZE_BUCKETS)
             log_message(f"Raw model output: {raw_model_output}")
             
             try:
-                response_data = json.loads(raw_model_output)
-                if not isinstance(response_data, dict):
-                    raise TypeError("Response must be a JSON object.")
+                response_data, fixed = parse_model_response(raw_model_output)
+                repairs.extend(fixed)
+                if stream_parser and stream_parser.duplicate_action:
+                    raise ValueError("The response must have only one 'action' key.")
                 
                 thought = response_data.get('thought', 'No thought provided.')
                 actions_data = response_data.get('action', {})
-                log_message(f"AI thought: {thought}")
+                if not thought_log.logged: log_message(f"AI thought: {thought}")
 
                 actions_to_execute = []
                 if isinstance(actions_data, list):
@@ -337,145 +2773,385 @@ This is a **non-blocking** workflow. Use this ONLY if you want to start a long-r
                 if not actions_to_execute:
                     raise ValueError("The 'action' key cannot be empty.")
 
-                all_results = []
-                for action in actions_to_execute:
-                    if not isinstance(action, dict):
-                        all_results.append("TOOL_RESULT for 'unknown':\nERROR: Items in the action list must be dictionaries.")
-                        continue
-
-                    action_name = action.get('name')
-                    parameters = action.get('parameters', {})
-
-                    if not action_name or not isinstance(action_name, str):
-                        all_results.append("TOOL_RESULT for 'unknown':\nERROR: Action object was missing a valid 'name' key.")
-                        continue
-                    
-                    if action_name not in tool_map:
-                         all_results.append(f"TOOL_RESULT for '{action_name}':\nERROR: The tool '{action_name}' does not exist.")
-                         continue
-                    
-                    tool_function = tool_map[action_name]
-                    if not isinstance(parameters, dict):
-                        all_results.append(f"TOOL_RESULT for '{action_name}':\nERROR: The 'parameters' field must be a dictionary.")
-                        continue
-
-                    result = tool_function(**parameters)
-                    log_message(f"Tool '{action_name}' result: {str(result)[:200]}...")
-                    all_results.append(f"TOOL_RESULT for '{action_name}':\n{result}")
+                # The streamed actions are always a prefix of the parsed list; start whatever the scanner left over.
+                for action in actions_to_execute[len(dispatcher.submitted):]: dispatch(action)
+                all_results = dispatcher.results()
+                if repairs:
+                    repairs = list(dict.fromkeys(repairs))
+                    metrics.inc("agent_repaired_responses_total")
+                    for repair in repairs: metrics.inc("agent_response_repairs_total", repair=repair)
+                    log_message(f"Repaired the response instead of asking the model again: {', '.join(repairs)}.")
 
                 next_input = "\n\n".join(all_results)
+                _journal({"type": "tool_results", "text": next_input})
+                # Results that only say the agent finished, waited or spoke are sent after the idle interval, not at once.
+                task_manager = session.task_manager
+                results_idle = (all(isinstance(action, dict) and action.get('name') in IDLE_ACTIONS for action, _ in dispatcher.submitted)
+                                and not (task_manager.running or task_manager.queued_count()))
+                metrics.observe("agent_cycle_seconds", time.perf_counter() - cycle_started)
+                if profiler: profiler.cycle_done()
 
             except (json.JSONDecodeError, TypeError, ValueError) as e:
+                metrics.inc("agent_malformed_responses_total")
                 log_message(f"AI response was malformed. Prompting it to recover. Error: {e}")
                 log_message(f"Invalid Response: ```{raw_model_output}```")
                 next_input = f"ERROR_CONTEXT: Your last response was not valid. The 'action' field must be a dictionary or a list of dictionaries, and the JSON must be correct. Error: {e}"
+                if dispatcher.submitted:
+                    next_input += "\n\nThese actions from it had already been started and have run:\n\n" + "\n\n".join(dispatcher.results())
+                    _journal({"type": "tool_results", "text": next_input})
                 continue
 
         except Exception as e:
             log_message(f"!!! AGENT ERROR (Main Loop): {e} !!!")
+            scheduler.record_failure(e)
             next_input = None
             continue
-        
-        finally:
-            log_message("Entering 6-second cooldown before next cycle.")
-            time.sleep(6)
 
 
-# --- The Main UI Thread (with word wrap) ---
-def main(stdscr):
+# --- Headless Agent Server ---
+
+class _ClientConnection:
+    """One API client: its subscriptions and a bounded outbox drained with backpressure."""
+    def __init__(self, writer):
+        self.writer = writer
+        self.subscriptions = set() # (session name, stream) pairs
+        self.responses = deque()
+        self.events = deque()
+        self.dropped = 0
+        self.ready = asyncio.Event()
+
+    def offer(self, event):
+        if (event["session"], event["stream"]) not in self.subscriptions: return
+        if len(self.events) >= SUBSCRIBER_QUEUE_SIZE:
+            self.events.popleft()
+            self.dropped += 1
+        self.events.append(event)
+        self.ready.set()
+
+    def respond(self, response):
+        self.responses.append(response)
+        self.ready.set()
+
+    async def send_loop(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            batch = list(self.responses)
+            self.responses.clear()
+            if self.dropped:
+                batch.append({"type": "dropped", "count": self.dropped})
+                self.dropped = 0
+            batch.extend(self.events)
+            self.events.clear()
+            self.writer.write("".join(json.dumps(item) + "\n" for item in batch).encode())
+            # While a slow client drains, new events pile up in the bounded deque instead of blocking the agent.
+            await self.writer.drain()
+
+def _handle_request(client, request):
+    op = request.get("op")
+    session_name = request.get("session", DEFAULT_SESSION)
+    if op == "sessions":
+        return {"ok": True, "sessions": [{"name": session.name, "running": session.thread is not None, "running_tasks": session.task_manager.running,
+                                          "queued_tasks": session.task_manager.queued_count()} for session in list(host.sessions.values())]}
+    if op == "start":
+        host.start(session_name)
+        return {"ok": True, "session": session_name}
+    session = host.sessions.get(session_name)
+    if session is None or session.thread is None: return {"ok": False, "error": f"No running session named {session_name!r}; start it with the 'start' op."}
+    if op == "suggest":
+        text = request.get("text")
+        if not isinstance(text, str) or not text.strip(): return {"ok": False, "error": "'text' must be a non-empty string."}
+        session.suggest(text)
+        return {"ok": True}
+    if op == "subscribe":
+        streams = request.get("streams", list(API_STREAMS))
+        if not _valid_streams(streams): return {"ok": False, "error": f"'streams' must be a list of {', '.join(API_STREAMS)}."}
+        client.subscriptions.update((session.name, stream) for stream in streams)
+        if request.get("backlog", True):
+            for stream, history in (("log", session.log_history), ("chat", session.chat_history)):
+                if stream in streams:
+                    for line in list(history): client.offer({"session": session.name, "stream": stream, "line": line, "backlog": True})
+        return {"ok": True, "streams": sorted(stream for name, stream in client.subscriptions if name == session.name)}
+    if op == "unsubscribe":
+        streams = request.get("streams", list(API_STREAMS))
+        if not _valid_streams(streams): return {"ok": False, "error": f"'streams' must be a list of {', '.join(API_STREAMS)}."}
+        client.subscriptions.difference_update((session.name, stream) for stream in streams)
+        return {"ok": True, "streams": sorted(stream for name, stream in client.subscriptions if name == session.name)}
+    task_manager = session.task_manager
+    if op == "tasks":
+        return {"ok": True, "tasks": [{"name": name, "status": task["status"], "command": task["command"]} for name, task in list(task_manager.tasks.items())]}
+    if op == "task":
+        name = request.get("name")
+        if name not in task_manager: return {"ok": False, "error": f"No task named {name!r}."}
+        return {"ok": True, "name": name, "status": task_manager.get(name)["status"], "result": session.call(check_task_result, name)}
+    if op == "status":
+        return {"ok": True, "running_tasks": task_manager.running, "queued_tasks": task_manager.queued_count(), "pending_suggestions": len(session.user_to_agent_queue)}
+    return {"ok": False, "error": f"Unknown op {op!r}."}
+
+def _valid_streams(streams):
+    return isinstance(streams, list) and all(isinstance(stream, str) and stream in API_STREAMS for stream in streams)
+
+async def _discard_line(reader):
+    """Reads past the end of an overlong line, however much of it is still to arrive."""
+    while True:
+        try:
+            await reader.readuntil(b"\n")
+            return
+        except asyncio.LimitOverrunError as e:
+            await reader.readexactly(e.consumed)
+
+async def _handle_client(reader, writer):
+    client = _ClientConnection(writer)
+    event_hub.listeners.append(client.offer)
+    sender = asyncio.create_task(client.send_loop())
+    try:
+        while True:
+            # Not readline(): after an overlong line it may have dropped the newline or only part of the line.
+            try: line = await reader.readuntil(b"\n")
+            except asyncio.IncompleteReadError as e: line = e.partial # Last line without a newline, or end of input
+            except asyncio.LimitOverrunError:
+                await _discard_line(reader)
+                client.respond({"ok": False, "error": f"Invalid request: lines are limited to {API_LINE_LIMIT} bytes."})
+                continue
+            if not line: break
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict): raise ValueError("request must be a JSON object")
+                response = _handle_request(client, request)
+            except ValueError as e:
+                request, response = {}, {"ok": False, "error": f"Invalid request: {e}"}
+            except Exception as e:
+                # Anything else is a bug in this server: answer the request rather than drop the client.
+                log_message(f"API request {request.get('op')!r} failed: {e}")
+                response = {"ok": False, "error": f"Request failed: {e}"}
+            if "id" in request: response["id"] = request["id"]
+            client.respond(response)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        event_hub.listeners.remove(client.offer)
+        sender.cancel()
+        writer.close()
+
+def _echo_log(event):
+    if event["stream"] != "log": return
+    print(event["line"] if event["session"] == DEFAULT_SESSION else f"{event['session']}: {event['line']}", flush=True)
+
+async def serve(socket_path, sessions=(DEFAULT_SESSION,), echo_logs=False, ready=None, stop=None):
+    """Runs the agent loops of `sessions` and serves the JSON-lines API on a Unix socket until `stop` is set.
+
+    Requests are JSON objects, one per line, with an "op" of suggest, subscribe, unsubscribe,
+    tasks, task, status, start or sessions, and an optional "session" (default "default");
+    an "id" is echoed back in the response. Subscribed streams (log, chat, task) arrive as
+    {"session": ..., "stream": ..., ...} events on the same connection.
+    """
+    loop = asyncio.get_running_loop()
+    event_hub.attach(loop)
+    stop = stop or asyncio.Event()
+    if echo_logs: event_hub.listeners.append(_echo_log)
+    if os.path.exists(socket_path): os.remove(socket_path)
+    server = await asyncio.start_unix_server(_handle_client, path=socket_path, limit=API_LINE_LIMIT)
+    os.chmod(socket_path, 0o600)
+    # Agent loops make blocking API calls, so each keeps its own thread; the event loop only does I/O.
+    for name in sessions: host.start(name)
+    log_message(f"Agent API listening on {socket_path}")
+    if ready: ready.set()
+    try:
+        async with server: await stop.wait()
+    finally:
+        event_hub.attach(None)
+        if os.path.exists(socket_path): os.remove(socket_path)
+
+def run_headless(socket_path, sessions):
+    async def run():
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM): asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+        await serve(socket_path, sessions, echo_logs=True, stop=stop)
+    asyncio.run(run())
+
+def start_background_server(socket_path, sessions):
+    """Runs `serve` on its own event loop thread for the in-process UI. Returns once the socket is listening."""
+    ready = threading.Event()
+    threading.Thread(target=lambda: asyncio.run(serve(socket_path, sessions, ready=ready)), daemon=True).start()
+    ready.wait()
+
+# --- The Curses UI Client ---
+
+class AgentClient:
+    """Connects to the agent's socket API and mirrors one session's log and chat streams for the UI."""
+    def __init__(self, socket_path, session=DEFAULT_SESSION):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.session = session
+        self.log = deque(maxlen=HISTORY_LINES)
+        self.chat = deque(maxlen=HISTORY_LINES)
+        self.version = 0 # Bumped on every change the UI has to draw
+        self.wake_r, self.wake_w = os.pipe() # Written on every change so the UI's select() wakes up
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        self.send({"op": "start"})
+        self.send({"op": "subscribe", "streams": ["log", "chat"]})
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def send(self, request):
+        self.sock.sendall((json.dumps(dict(request, session=self.session)) + "\n").encode())
+
+    def suggest(self, text):
+        self.send({"op": "suggest", "text": text})
+
+    def _read_loop(self):
+        try:
+            for line in self.sock.makefile('r', encoding='utf-8'):
+                event = json.loads(line)
+                stream = event.get("stream")
+                if stream == "log": self.log.append(event["line"])
+                elif stream == "chat": self.chat.append(event["line"])
+                elif event.get("error"): self.log.append(f"Agent API error: {event['error']}")
+                elif event.get("type") == "dropped": self.log.append(f"[{event['count']} updates were dropped because the UI fell behind]")
+                else: continue
+                self._changed()
+        except (OSError, ValueError):
+            pass
+        self.log.append("Disconnected from the agent.")
+        self._changed()
+
+    def _changed(self):
+        self.version += 1
+        try: os.write(self.wake_w, b"\0")
+        except OSError: pass # A full pipe already guarantees a wakeup
+
+def _wrapped_tail(messages, width, rows, wrap_cache):
+    """Returns the last `rows` wrapped lines of `messages`. Each message is wrapped once per width."""
+    lines = []
+    for message in reversed(messages):
+        wrapped = wrap_cache.get(message)
+        if wrapped is None: wrapped = wrap_cache[message] = textwrap.wrap(message, width=width)
+        lines.extend(reversed(wrapped))
+        if len(lines) >= rows: break
+    return list(reversed(lines))[-rows:]
+
+def _draw_pane(win, title, messages, rows, width, wrap_cache):
+    win.erase(); win.box(); win.addstr(0, 2, title)
+    if width > 0:
+        for i, line in enumerate(_wrapped_tail(messages, width, rows, wrap_cache)):
+            win.addstr(i + 1, 2, line)
+    win.noutrefresh()
+
+def main(stdscr, client):
     curses.curs_set(1)
     stdscr.nodelay(True)
-    
-    agent_thread = threading.Thread(target=agent_thread_main, daemon=True)
-    agent_thread.start()
-    
+
+    # curses only notices SIGWINCH on its next getch(); route it through the wake pipe instead
+    # so a resize redraws immediately even while the UI is blocked in select().
+    resized = threading.Event()
+    signal.signal(signal.SIGWINCH, lambda signum, frame: resized.set())
+    signal.set_wakeup_fd(client.wake_w)
+
     current_input = ""
-    
+    windows = None
+    size = None
+    wrap_cache = {}
+    drawn_version = None
+    input_dirty = True
+
     while True:
         try:
+            if resized.is_set():
+                resized.clear()
+                curses.resizeterm(*os.get_terminal_size(sys.__stdout__.fileno())[::-1])
             height, width = stdscr.getmaxyx()
-            if height < 10 or width < 30:
-                stdscr.clear(); stdscr.addstr(0, 0, "Terminal too small"); stdscr.refresh()
-                time.sleep(0.1)
-                continue
+            if (height, width) != size:
+                size, windows, drawn_version, input_dirty = (height, width), None, None, True
+                wrap_cache.clear()
+                stdscr.erase()
+                if height < 10 or width < 30:
+                    stdscr.addstr(0, 0, "Terminal too small")
+                else:
+                    log_win_height = height // 2
+                    chat_win_height = height - log_win_height - 1
+                    windows = (
+                        curses.newwin(log_win_height, width, 0, 0),
+                        curses.newwin(chat_win_height, width, log_win_height, 0),
+                        curses.newwin(1, width, height - 1, 0),
+                    )
+                stdscr.noutrefresh()
 
-            log_win_height = height // 2
-            chat_win_height = height - log_win_height - 1
-            
-            log_win = curses.newwin(log_win_height, width, 0, 0)
-            chat_win = curses.newwin(chat_win_height, width, log_win_height, 0)
-            status_win = curses.newwin(1, width, height - 1, 0)
-
-            if not agent_thread.is_alive(): 
-                log_message("FATAL: Agent thread has died.")
-
-            log_win.clear(); log_win.box(); log_win.addstr(0, 2, " Agent Log ")
-            available_width = width - 4
-            final_log_lines = []
-            if available_width > 0:
-                log_lines_to_render = []
-                for message in reversed(log_history):
-                    wrapped = textwrap.wrap(message, width=available_width)
-                    log_lines_to_render.extend(reversed(wrapped))
-                    if len(log_lines_to_render) >= log_win_height - 2: break
-                final_log_lines = list(reversed(log_lines_to_render))[-(log_win_height-2):]
-            
-            for i, line in enumerate(final_log_lines):
-                log_win.addstr(i + 1, 2, line)
-            log_win.refresh()
+            if windows:
+                log_win, chat_win, status_win = windows
+                available_width = width - 4
+                if drawn_version != client.version:
+                    drawn_version = client.version
+                    if len(wrap_cache) > 4 * (client.log.maxlen + client.chat.maxlen): wrap_cache.clear()
+                    _draw_pane(log_win, " Agent Log ", list(client.log), log_win.getmaxyx()[0] - 2, available_width, wrap_cache)
+                    _draw_pane(chat_win, " Conversation ", list(client.chat), chat_win.getmaxyx()[0] - 2, available_width, wrap_cache)
+                    input_dirty = True # Keep the cursor on the input line
+                if input_dirty:
+                    input_dirty = False
+                    status_win.erase()
+                    prompt = f"You: {current_input}"
+                    wrapped_input = textwrap.wrap(prompt, width=width-1)
+                    display_line = "" if not wrapped_input else wrapped_input[-1]
+                    status_win.addstr(0, 0, display_line)
+                    status_win.noutrefresh()
+            curses.doupdate()
+            _trace_startup("first_frame")
 
-            while agent_to_user_queue: 
-                chat_history.append(f"Agent: {agent_to_user_queue.popleft()}")
-            
-            chat_win.clear(); chat_win.box(); chat_win.addstr(0, 2, " Conversation ")
-            final_chat_lines = []
-            if available_width > 0:
-                chat_lines_to_render = []
-                for message in reversed(chat_history):
-                    wrapped = textwrap.wrap(message, width=available_width)
-                    chat_lines_to_render.extend(reversed(wrapped))
-                    if len(chat_lines_to_render) >= chat_win_height - 2: break
-                final_chat_lines = list(reversed(chat_lines_to_render))[-(chat_win_height-2):]
-
-            for i, line in enumerate(final_chat_lines):
-                chat_win.addstr(i + 1, 2, line)
-            chat_win.refresh()
-
-            status_win.clear()
-            prompt = f"You: {current_input}"
-            if width > 0:
-                wrapped_input = textwrap.wrap(prompt, width=width-1)
-                display_line = "" if not wrapped_input else wrapped_input[-1]
-                status_win.addstr(0, 0, display_line)
-            status_win.refresh()
+            readable, _, _ = select.select([sys.stdin, client.wake_r], [], [], UI_IDLE_TIMEOUT)
+            if client.wake_r in readable:
+                try:
+                    while os.read(client.wake_r, 4096): pass
+                except BlockingIOError: pass
 
             key = stdscr.getch()
-            if key != -1:
+            while key != -1:
                 if key == curses.KEY_ENTER or key in [10, 13]:
                     if current_input:
-                        user_to_agent_queue.append(current_input)
-                        chat_history.append(f"You: {current_input}")
+                        client.suggest(current_input)
                         current_input = ""
                 elif key == curses.KEY_BACKSPACE or key == 127:
                     current_input = current_input[:-1]
                 elif 32 <= key <= 126:
                     current_input += chr(key)
-            
-            time.sleep(0.1)
+                input_dirty = True
+                key = stdscr.getch()
         except KeyboardInterrupt:
-            save_state()
             break
         except curses.error:
-            pass 
+            pass
+    signal.set_wakeup_fd(-1)
 
 if __name__ == "__main__":
-    if not os.getenv("GOOGLE_API_KEY"):
+    parser = argparse.ArgumentParser(description="Autonomous agent with a curses UI and a local JSON-lines socket API.")
+    parser.add_argument("--headless", action="store_true", help="Run the agent and its socket API without the UI (e.g. under systemd).")
+    parser.add_argument("--connect", action="store_true", help="Only open the UI, attached to an agent already running with --headless.")
+    parser.add_argument("--socket", default=AGENT_SOCKET, help=f"Path of the agent's Unix socket (default: {AGENT_SOCKET}).")
+    parser.add_argument("--session", action="append", dest="sessions", metavar="NAME",
+                        help=f"Session to run, or with --connect to attach to; repeat to host several (default: {DEFAULT_SESSION}). The UI shows the first.")
+    parser.add_argument("--replay", metavar="SCRIPT", help="Play model responses back from a JSON-lines script instead of calling the API (offline; see ReplayBackend).")
+    parser.add_argument("--record", metavar="SCRIPT", help="Append every model response and API error to SCRIPT for later --replay.")
+    args = parser.parse_args()
+    sessions = args.sessions or [DEFAULT_SESSION]
+    if args.replay: host.backend = ReplayBackend(args.replay)
+    if args.record: host.backend = RecordingBackend(host.backend, args.record)
+    if args.connect:
+        try:
+            curses.wrapper(main, AgentClient(args.socket, sessions[0]))
+        except OSError as e:
+            print(f"Could not connect to the agent at {args.socket}: {e}")
+    elif not args.replay and not os.getenv("GOOGLE_API_KEY"):
         print("Error: GOOGLE_API_KEY environment variable not set.")
     else:
         try:
-            curses.wrapper(main)
+            start_metrics_exporters()
+            for name in sessions: host.session(name) # Reject bad names before anything starts
+            if args.headless:
+                run_headless(args.socket, sessions)
+            else:
+                start_background_server(args.socket, sessions)
+                curses.wrapper(main, AgentClient(args.socket, sessions[0]))
         except Exception as e:
             print(f"An unexpected error occurred: {e}")
         finally:
-            save_state()
+            host.shutdown()
+            if os.path.exists(args.socket): os.remove(args.socket)
             print("Agent shut down.")